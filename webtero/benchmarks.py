@@ -0,0 +1,271 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""Benchmarks for the zotero reader and the website generator, using synthetic libraries served 
+by a local MockZoteroServer. The results are saved as json, so that they can be compared between 
+releases.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from StringIO import StringIO
+from collections import OrderedDict
+
+from PIL import Image
+
+import website_generator
+from zotero_cache import ZoteroCache
+from zotero_files import AttachmentStore, set_api_url, set_store
+from zotero_scheduler import RequestScheduler, set_scheduler
+from zotero_reader import ZoteroCollectionTree, get_path_group, invalidate_group, set_cache, \
+    set_credentials
+from website_templates import create_environment, set_environment
+from website_generator import TabbedWebsite
+from zotero_mock_server import MockLibrary, MockZoteroServer
+
+# ================================================================================================
+# Scales
+# ================================================================================================
+
+GROUP_NAME = u'Benchmark'
+
+# The synthetic libraries: the number of items, the depth and width of the collection tree, the 
+# number of tabs, and the number of images in each tab. With throttle_every, the server refuses 
+# every throttle_every request with '429 Too Many Requests', to check that the reader retries. 
+# This library is small, since pyzotero 1.3 also waits after each 429, longer each time.
+SCALES = OrderedDict([
+    ('small', {'items': 10, 'depth': 1, 'width': 5, 'tabs': 3, 'images': 0}),
+    ('medium', {'items': 1000, 'depth': 1, 'width': 20, 'tabs': 10, 'images': 0}),
+    ('deep', {'items': 1000, 'depth': 50, 'width': 4, 'tabs': 10, 'images': 0}),
+    ('large', {'items': 50000, 'depth': 5, 'width': 20, 'tabs': 20, 'images': 0}),
+    ('images', {'items': 10, 'depth': 1, 'width': 5, 'tabs': 5, 'images': 4}),
+    ('throttled', {'items': 10, 'depth': 1, 'width': 3, 'tabs': 2, 'images': 0, 
+                   'throttle_every': 4}),
+])
+
+# The size of the synthetic images
+IMAGE_SIZE = (1600, 1200)
+
+def create_library(items, depth, width, tabs, images, seed=0):
+    """Creates a MockLibrary with a website. The 'Data' collection has a tree of collections, 
+    depth levels deep with width collections at each level, and the items are spread over these 
+    collections. The website is in 'Websites/Site', with the template in 'Websites/_Files' and the
+    images in 'Websites/_Images'. Each tab has some headings and paragraphs, and a number of 
+    images.
+    """
+    library = MockLibrary(1, GROUP_NAME, seed)
+    # The collection tree
+    data_colls = []
+    parent = library.add_collection(u'Data')
+    for level in range(depth):
+        level_colls = [library.add_collection(u'Level ' + str(level) + u' ' + str(number), parent)
+                       for number in range(width)]
+        data_colls.extend(level_colls)
+        parent = level_colls[0]
+    # The website
+    websites = library.add_collection(u'Websites')
+    site = library.add_collection(u'Site', websites)
+    files = library.add_collection(u'_Files', websites)
+    images_coll = library.add_collection(u'_Images', websites)
+    template = library.add_item(u'Template', [files])
+    library.add_attachment(template, u'template.html', 
+                           "<html><head><title>{{ head.title }}</title></head><body>" 
+                           "<ul>{{ buttons }}</ul>{{ content }}</body></html>", u'text/html')
+    library.add_item(u'Head', [site], item_type=u'webpage')
+    image_data = _create_image_data(IMAGE_SIZE)
+    images_item = library.add_item(u'Images', [images_coll])
+    for tab_number in range(tabs):
+        html = ["<html><body>"]
+        for section in range(5):
+            html.append("<h1>Section " + str(section) + "</h1>")
+            html.append("<h2>Part</h2><p>" + "Some text for the benchmark. " * 20 + "</p>")
+        for image_number in range(images):
+            filename = "image_" + str(tab_number) + "_" + str(image_number) + ".jpg"
+            library.add_attachment(images_item, filename, image_data, u'image/jpeg')
+            html.append('<p><img src="' + filename + '" width="640"></p>')
+        html.append("</body></html>")
+        tab = library.add_item(u'Tab ' + str(tab_number), [site], callNumber=unicode(tab_number))
+        library.add_attachment(tab, u'tab.html', "".join(html), u'text/html')
+    # The other items
+    for number in range(max(0, items - tabs)):
+        library.add_item(u'Item ' + str(number), [data_colls[number % len(data_colls)]])
+    return library
+
+def _create_image_data(size):
+    """Returns the data of a jpeg image.
+    """
+    image = Image.new('RGB', size)
+    image.putdata([(x % 256, y % 256, (x + y) % 256) for y in range(size[1]) for x in range(size[0])])
+    image_file = StringIO()
+    image.save(image_file, 'JPEG', quality=90)
+    return image_file.getvalue()
+
+# ================================================================================================
+# Benchmarks
+# ================================================================================================
+
+class Benchmark(object):
+    """Runs the benchmarks for one scale. A MockZoteroServer is started for the library, and the 
+    reader uses a new cache, store and template environment in a temp folder, so every run starts 
+    cold. Each stage is timed separately, and the results are a list of dicts.
+    """
+    def __init__(self, scale_name, settings, latency=0.0):
+        self.scale_name = scale_name
+        self.settings = settings
+        self.latency = latency
+        self.results = []
+        self.dirpath = None
+        self.library = None
+        self.server = None
+
+    def _time(self, stage, func, count=None):
+        """Times a call to func(). The count is the number of things that were processed, or a 
+        function that returns it, called with the result of func().
+        """
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        if callable(count):
+            count = count(result)
+        self.results.append({'scale': self.scale_name, 'stage': stage, 'seconds': seconds, 
+                             'count': count})
+        print "  " + stage + ": " + ("%.3f" % seconds) + "s (" + str(count) + ")"
+        return result
+
+    def setup(self):
+        """Creates the library, starts the server, and points the reader at it.
+        """
+        self.dirpath = tempfile.mkdtemp(prefix='webtero_benchmark_')
+        settings = dict(self.settings)
+        throttle_every = settings.pop('throttle_every', 0)
+        self.library = create_library(**settings)
+        self.server = MockZoteroServer([self.library], latency=self.latency, 
+                                       throttle_every=throttle_every, retry_after=0)
+        self.server.start()
+        set_api_url(self.server.get_url())
+        set_credentials('benchmark', 'benchmark')
+        set_scheduler(RequestScheduler(rate=1000000.0, burst=1000000, backoff=0.01))
+        set_cache(ZoteroCache(os.path.join(self.dirpath, 'cache.sqlite')))
+        set_store(AttachmentStore(os.path.join(self.dirpath, 'attachments')))
+        set_environment(create_environment())
+        website_generator._PARSED_HTML.clear()
+        invalidate_group()
+
+    def teardown(self):
+        """Stops the server and deletes the temp folder.
+        """
+        invalidate_group()
+        set_api_url(None)
+        self.server.stop()
+        shutil.rmtree(self.dirpath)
+
+    def run(self):
+        """Runs all the stages. Returns the results.
+        """
+        print "Benchmark '" + self.scale_name + "': " + str(self.settings)
+        self.setup()
+        try:
+            self._run_reader()
+            self._run_website()
+        finally:
+            self.teardown()
+        return self.results
+
+    def _run_reader(self):
+        """Times the enumeration of the collections and their items, and the collection paths.
+        """
+        group = self._time('connect', lambda: get_path_group(GROUP_NAME + u'/Data'), 
+                           lambda group: len(group.collections))
+        collections = group.collections.values()
+        self._time('collection_items', lambda: sum(len(coll.get_items()) for coll in collections),
+                   lambda count: count)
+        colls_data = group._colls_data
+        self._time('collection_tree', lambda: ZoteroCollectionTree(colls_data), len(colls_data))
+        uids = [coll_data[u'collectionKey'] for coll_data in colls_data] * 10
+        self._time('get_coll_path', lambda: [group._get_coll_path(uid) for uid in uids], len(uids))
+        self._check_reader(group)
+
+    def _check_reader(self, group):
+        """Checks that the reader read every collection and item in the library, e.g. that the 
+        requests refused by the server were retried. Raises an exception if not.
+        """
+        for coll_uid, coll_data in self.library.collections.iteritems():
+            coll = group.collections_by_uid.get(coll_uid)
+            if coll is None:
+                raise Exception("The collection '" + coll_data[u'name'] + "' was not read.")
+            expected = sorted(key for key, data in self.library.items.iteritems() 
+                              if coll_uid in data.get(u'collections', []))
+            if sorted(item.uid for item in coll.get_items()) != expected:
+                raise Exception("The items in '" + coll_data[u'name'] + "' were not read.")
+
+    def _run_website(self):
+        """Times the stages of creating the website: reading the data, the html of the tabs, the 
+        images, and the whole website, once from scratch and once again with nothing changed.
+        """
+        website_filepath = os.path.join(self.dirpath, 'site', 'index.html')
+        images_dirpath = os.path.join(self.dirpath, 'site', 'img')
+        os.makedirs(images_dirpath)
+        site_path = GROUP_NAME + u'/Websites/'
+        website = TabbedWebsite(site_path + u'Site', site_path + u'_Files', site_path + u'_Images')
+        self._time('initialize_data', website.initialize_data, lambda _: len(website.tabs))
+        self._time('get_html', lambda: [tab.html_content.get_html('./img/') 
+                                        for tab in website.tabs], len(website.tabs))
+        image_tags = [image_tag for tab in website.tabs 
+                      for image_tag in tab.html_content.image_tags.values()]
+        self._time('create_image_files', lambda: website._create_image_files(images_dirpath), 
+                   len(image_tags))
+        shutil.rmtree(images_dirpath)
+        os.makedirs(images_dirpath)
+        self._time('create_website', lambda: website.create_website(
+            website_filepath, './img/', images_dirpath), len(website.tabs))
+        website = TabbedWebsite(site_path + u'Site', site_path + u'_Files', site_path + u'_Images')
+        website.initialize_data()
+        self._time('create_website_unchanged', lambda: website.create_website(
+            website_filepath, './img/', images_dirpath), len(website.tabs))
+
+def run_benchmarks(scale_names=None, latency=0.0):
+    """Runs the benchmarks for a list of scales (by default all of them). Returns a dict with the 
+    results, and some info about the machine.
+    """
+    results = []
+    for scale_name in scale_names or SCALES.keys():
+        results.extend(Benchmark(scale_name, SCALES[scale_name], latency).run())
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 
+            'platform': platform.platform(), 'latency': latency, 'results': results}
+
+# ================================================================================================
+# Main
+# ================================================================================================
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: benchmarks.py results.json [scale ...]"
+        print "Scales: " + ", ".join(SCALES.keys())
+        sys.exit(1)
+    report = run_benchmarks(sys.argv[2:])
+    with open(sys.argv[1], 'w') as results_file:
+        json.dump(report, results_file, indent=1, sort_keys=True)
+    print "Saved results to " + sys.argv[1]
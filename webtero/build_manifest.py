@@ -0,0 +1,123 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A manifest of the files created by a build, used to skip files that do not need to change.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+# ================================================================================================
+# Manifest
+# ================================================================================================
+
+class BuildManifest(object):
+    """A record of the files created by the last build, saved as a json file. For each output 
+    file, the manifest saves a hash of the inputs that the file was created from (e.g. the item 
+    versions, the template hash and the image hashes), and the size and modification time of the 
+    file. On the next build, a file only needs to be created again if the inputs have changed, 
+    or if the file was changed or deleted.
+
+    The manifest also saves fragments, parts of an output (e.g. the html of a tab) that are kept 
+    so that they can be reused if their inputs have not changed.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.outputs = {}
+        self.fragments = {}
+        if os.path.isfile(filepath):
+            try:
+                with open(filepath, 'r') as manifest_file:
+                    data = json.load(manifest_file)
+                self.outputs = data[u'outputs']
+                self.fragments = data.get(u'fragments', {})
+            except (ValueError, KeyError):
+                # A broken manifest is the same as no manifest, everything is created again
+                self.outputs = {}
+                self.fragments = {}
+
+    def is_current(self, output_filepath, inputs):
+        """Returns True if the output file exists and was created from the same inputs. The inputs
+        can be any data that can be saved as json.
+        """
+        record = self.outputs.get(output_filepath)
+        if record is None or record[u'inputs'] != get_inputs_hash(inputs):
+            return False
+        if not os.path.isfile(output_filepath):
+            return False
+        stat = os.stat(output_filepath)
+        return record[u'size'] == stat.st_size and record[u'mtime'] == stat.st_mtime
+
+    def update(self, output_filepath, inputs):
+        """Records that the output file was created from the inputs. Call this after the file has
+        been written.
+        """
+        stat = os.stat(output_filepath)
+        self.outputs[output_filepath] = {
+            u'inputs': get_inputs_hash(inputs), u'size': stat.st_size, u'mtime': stat.st_mtime}
+
+    def get_fragment(self, key, inputs):
+        """Returns the data of a fragment, or None if there is no fragment for this key that was 
+        created from the same inputs. 
+        """
+        record = self.fragments.get(key)
+        if record is None or record[u'inputs'] != get_inputs_hash(inputs):
+            return None
+        return dict((name, value.encode('utf-8')) for name, value in record[u'data'].items())
+
+    def set_fragment(self, key, inputs, data):
+        """Saves the data of a fragment, created from the inputs. The data must be a dict of 
+        utf-8 encoded strs, it is returned in the same form by get_fragment().
+        """
+        self.fragments[key] = {u'inputs': get_inputs_hash(inputs), u'data': 
+                               dict((name, value.decode('utf-8')) for name, value in data.items())}
+
+    def prune_fragments(self, keys):
+        """Deletes all the fragments that are not in the list of keys.
+        """
+        keys = set(keys)
+        for key in self.fragments.keys():
+            if key not in keys:
+                del self.fragments[key]
+
+    def save(self):
+        """Saves the manifest. The file is written to a temp file that is then renamed.
+        """
+        dirpath = os.path.dirname(os.path.abspath(self.filepath))
+        handle, temp_filepath = tempfile.mkstemp(prefix='.manifest_', dir=dirpath)
+        with os.fdopen(handle, 'w') as manifest_file:
+            json.dump({u'outputs': self.outputs, u'fragments': self.fragments}, manifest_file, 
+                      indent=1, sort_keys=True)
+        os.rename(temp_filepath, self.filepath)
+
+
+def get_inputs_hash(inputs):
+    """Returns a sha1 hex digest for some inputs, that can be any data that can be saved as json.
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def get_manifest_filepath(website_filepath):
+    """Returns the path of the manifest for a website, a hidden file next to the html file.
+    """
+    dirpath, filename = os.path.split(website_filepath)
+    return os.path.join(dirpath, '.' + filename + '.manifest.json')
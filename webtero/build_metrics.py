@@ -0,0 +1,327 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""Metrics about the builds and the requests to the zotero api, e.g. the number of requests, their 
+latency, the bytes downloaded, and the time to render the tabs and resize the images. The metrics 
+are kept in a MetricsRegistry, and can be written to a text file that is read by the textfile 
+collector of the prometheus node_exporter.
+"""
+
+import os
+import tempfile
+import threading
+
+# The buckets of the histograms for requests and other short things, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# The buckets of the histograms for whole builds, in seconds
+BUILD_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+# The metrics that are recorded by webtero: (type, name, help, label names, buckets)
+WEBTERO_METRICS = (
+    ('counter', 'webtero_api_requests_total', 
+     "Requests to the zotero api, including retries, by endpoint and http status.", 
+     ('endpoint', 'status'), None),
+    ('histogram', 'webtero_api_request_duration_seconds', 
+     "Time until zotero answered a request, by endpoint.", 
+     ('endpoint',), DEFAULT_BUCKETS),
+    ('counter', 'webtero_api_cache_total', 
+     "Api responses that were read from the cache (hit), renewed after checking the versions " + 
+     "of the objects (renewed), or downloaded (miss).", 
+     ('result',), None),
+    ('counter', 'webtero_attachments_fetched_total', 
+     "Attachment files that were got from the attachment store or downloaded from zotero.", 
+     ('source',), None),
+    ('counter', 'webtero_download_bytes_total', 
+     "Bytes of attachment files downloaded from zotero.", 
+     (), None),
+    ('counter', 'webtero_images_resized_total', 
+     "Image files that were resized, by status (ok or error).", 
+     ('status',), None),
+    ('histogram', 'webtero_image_resize_duration_seconds', 
+     "Time to resize one image file.", 
+     (), DEFAULT_BUCKETS),
+    ('counter', 'webtero_tabs_rendered_total', 
+     "Tabs that were rendered, or taken from the build manifest (cached).", 
+     ('result',), None),
+    ('histogram', 'webtero_tab_render_duration_seconds', 
+     "Time to render the content of one tab.", 
+     (), DEFAULT_BUCKETS),
+    ('histogram', 'webtero_build_duration_seconds', 
+     "Time to build a website, by stage (data or website).", 
+     ('stage',), BUILD_BUCKETS),
+    ('gauge', 'webtero_build_last_timestamp_seconds', 
+     "Unix time when a stage of a build last finished.", 
+     ('stage',), None),
+    ('counter', 'webtero_build_errors_total', 
+     "Errors in the build report, by stage.", 
+     ('stage',), None),
+)
+
+# ================================================================================================
+# Metrics
+# ================================================================================================
+
+class Metric(object):
+    """The base class of the metrics. A metric has a name, a help str, and the names of its labels.
+    A value is kept for each combination of label values. Values can be changed from many threads
+    at the same time.
+    """
+    kind = None
+
+    def __init__(self, name, help_str, label_names=()):
+        self.name = name
+        self.help_str = help_str
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, labels):
+        """Returns the tuple of label values, in the same order as the label names.
+        """
+        if set(labels) != set(self.label_names):
+            raise ValueError("The labels of '" + self.name + "' are: " + 
+                             ", ".join(self.label_names))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get_lines(self):
+        """Returns the lines of text for this metric, in the prometheus text format.
+        """
+        lines = ["# HELP " + self.name + " " + _escape(self.help_str, False), 
+                 "# TYPE " + self.name + " " + self.kind]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.label_names:
+            values = [((), self._get_empty_value())]
+        for key, value in values:
+            lines.extend(self._get_sample_lines(key, value))
+        return lines
+
+    def _get_empty_value(self):
+        return 0
+
+    def _get_sample_lines(self, key, value):
+        return [self.name + _format_labels(self.label_names, key) + " " + _format_value(value)]
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of requests.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Adds an amount to the value for the labels.
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Returns the value for the labels.
+        """
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the time of the last build.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Sets the value for the labels.
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels):
+        """Returns the value for the labels.
+        """
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Histogram(Metric):
+    """Counts the values that are observed, e.g. durations, in buckets. The buckets are the upper 
+    bounds, and each bucket counts the values that are less than or equal to its bound. The sum 
+    and the count of all the values are also kept.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_str, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Adds a value to the buckets for the labels.
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = self._get_empty_value()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def get_count(self, **labels):
+        """Returns the number of values that were observed for the labels.
+        """
+        counts = self._values.get(self._get_key(labels))
+        return counts[-1] if counts else 0
+
+    def _get_empty_value(self):
+        # The count for each bucket, the sum, and the count
+        return [0] * len(self.buckets) + [0.0, 0]
+
+    def _get_sample_lines(self, key, value):
+        lines = []
+        bucket_names = self.label_names + ('le',)
+        for bound, count in zip(self.buckets, value):
+            lines.append(self.name + "_bucket" + 
+                         _format_labels(bucket_names, key + (_format_value(float(bound)),)) + 
+                         " " + _format_value(count))
+        lines.append(self.name + "_bucket" + _format_labels(bucket_names, key + ('+Inf',)) + 
+                     " " + _format_value(value[-1]))
+        labels_str = _format_labels(self.label_names, key)
+        lines.append(self.name + "_sum" + labels_str + " " + _format_value(value[-2]))
+        lines.append(self.name + "_count" + labels_str + " " + _format_value(value[-1]))
+        return lines
+
+# ================================================================================================
+# Registry
+# ================================================================================================
+
+class MetricsRegistry(object):
+    """A set of metrics, by name. The webtero metrics (see WEBTERO_METRICS) are created when the 
+    registry is created, so that they are all in the text file, even before they have values.
+    """
+    def __init__(self, metrics=WEBTERO_METRICS):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        for kind, name, help_str, label_names, buckets in metrics:
+            if kind == 'counter':
+                self.add(Counter(name, help_str, label_names))
+            elif kind == 'gauge':
+                self.add(Gauge(name, help_str, label_names))
+            elif kind == 'histogram':
+                self.add(Histogram(name, help_str, label_names, buckets))
+            else:
+                raise ValueError("Unknown type of metric: '" + kind + "'.")
+
+    def add(self, metric):
+        """Adds a metric. Returns the metric.
+        """
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError("There is already a metric called '" + metric.name + "'.")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        """Returns the metric with this name.
+        """
+        return self.metrics[name]
+
+    def inc(self, name, amount=1, **labels):
+        """Adds an amount to a counter.
+        """
+        self.metrics[name].inc(amount, **labels)
+
+    def set(self, name, value, **labels):
+        """Sets the value of a gauge.
+        """
+        self.metrics[name].set(value, **labels)
+
+    def observe(self, name, value, **labels):
+        """Adds a value to a histogram.
+        """
+        self.metrics[name].observe(value, **labels)
+
+    def get_text(self):
+        """Returns all the metrics as a str in the prometheus text format, sorted by name and 
+        ending with '# EOF'.
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].get_lines())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filepath):
+        """Writes all the metrics to a text file, e.g. 'webtero.prom' in the directory of the 
+        node_exporter textfile collector. The file is written to a temp file that is then renamed, 
+        so the collector never reads a partly written file.
+        """
+        dirpath = os.path.dirname(os.path.abspath(filepath))
+        handle, temp_filepath = tempfile.mkstemp(prefix='.metrics_', dir=dirpath)
+        with os.fdopen(handle, 'w') as metrics_file:
+            metrics_file.write(self.get_text())
+        os.chmod(temp_filepath, 0644)
+        os.rename(temp_filepath, filepath)
+
+# ================================================================================================
+# Utility functions to format the text
+# ================================================================================================
+
+def _escape(value, quotes=True):
+    """Escapes the backslashes and new lines in a str, and the double quotes if quotes is True.
+    """
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
+
+def _format_labels(label_names, label_values):
+    """Returns the labels as a str like '{name1="value1",name2="value2"}', or '' if there are no 
+    labels.
+    """
+    if not label_names:
+        return ""
+    return "{" + ",".join(name + '="' + _escape(value) + '"' 
+                          for name, value in zip(label_names, label_values)) + "}"
+
+def _format_value(value):
+    """Returns a number as a str.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# ================================================================================================
+# The registry used by webtero
+# ================================================================================================
+
+_METRICS = []
+
+def get_metrics():
+    """Returns the MetricsRegistry where webtero records its metrics. It is created the first time 
+    it is needed.
+    """
+    if not _METRICS:
+        _METRICS.append(MetricsRegistry())
+    return _METRICS[0]
+
+def set_metrics(metrics):
+    """Sets the MetricsRegistry where webtero records its metrics.
+    """
+    del _METRICS[:]
+    _METRICS.append(metrics)
@@ -0,0 +1,327 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""Profiling of builds. A BuildProfiler profiles sections of a build with cProfile. Each section is
+a stage of the build (e.g. 'tab' or 'render') and optionally the zotero key of the item, 
+attachment or image that the section is about. While the profiler is running, a thread also 
+samples the stacks of the threads that are in a section. 
+
+The profiler writes a report with the most expensive stages, zotero keys and functions, a file of
+collapsed stacks that can be turned into a flamegraph (e.g. with flamegraph.pl or speedscope), and 
+a pstats file. Profiling makes a build slower, so it is only done when a profiler is given, e.g. 
+with the --profile option of the website daemon.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+
+# The time between samples of the stacks, in seconds
+SAMPLE_INTERVAL = 0.005
+# The functions of cProfile that are removed from the stats. When a section is nested, the outer
+# profile is disabled, and cProfile counts the time until it is enabled again as a call to disable.
+PROFILER_FUNCS = ("<method 'enable' of '_lsprof.Profiler' objects>", 
+                  "<method 'disable' of '_lsprof.Profiler' objects>")
+
+# ================================================================================================
+# Profiler
+# ================================================================================================
+
+class BuildProfiler(object):
+    """Profiles the sections of a build, see profile(). For each section, the profiler keeps the 
+    time, the number of times the section was run, and the cProfile stats. The time is the wall 
+    clock time in the section, less the time in the sections nested in it in the same thread.
+
+    The stacks are only sampled between start() and stop(). Sections that are run in other 
+    processes can be profiled with map_profiled(), and their data is merged into this profiler.
+    """
+    def __init__(self, sample_interval=SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        # (stage, key) -> [seconds, count, list of cProfile stats dicts]
+        self.sections = {}
+        # Collapsed stack -> number of samples
+        self.stacks = {}
+        # Thread ident -> list of the open sections, [stage, key, cProfile.Profile, nested seconds]
+        self._open = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Starts the thread that samples the stacks.
+        """
+        self._stopping.clear()
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        """Stops the thread that samples the stacks.
+        """
+        if self._sampler is not None:
+            self._stopping.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def profile(self, stage, key=None):
+        """Returns a context manager that profiles the code in a with statement as a section, e.g.
+        'with profiler.profile('tab', item.uid):'. Sections can be nested, and the code in the 
+        inner section is not counted in the outer section.
+        """
+        return _Section(self, stage, key)
+
+    def _open_section(self, stage, key):
+        ident = threading.current_thread().ident
+        with self._lock:
+            sections = self._open.setdefault(ident, [])
+            if sections:
+                sections[-1][2].disable()
+            section = [stage, key, cProfile.Profile(), 0.0]
+            sections.append(section)
+        section[2].enable()
+        return section
+
+    def _close_section(self, section, duration):
+        section[2].create_stats()
+        ident = threading.current_thread().ident
+        with self._lock:
+            sections = self._open[ident]
+            sections.pop()
+            if sections:
+                sections[-1][3] += duration
+                sections[-1][2].enable()
+            else:
+                del self._open[ident]
+        self._add(section[0], section[1], duration - section[3], 1, 
+                  [_remove_profiler_funcs(section[2].stats)])
+
+    def _add(self, stage, key, seconds, count, all_stats):
+        with self._lock:
+            data = self.sections.setdefault((stage, key), [0.0, 0, []])
+            data[0] += seconds
+            data[1] += count
+            data[2].extend(stats for stats in all_stats if stats)
+
+    def _sample(self):
+        """Samples the stacks of the threads that are in a section, until stop() is called. The 
+        stack is saved with the stage and the key of the section as the root frames.
+        """
+        while not self._stopping.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = [(ident, sections[-1][0], sections[-1][1]) 
+                           for ident, sections in self._open.iteritems()]
+            for ident, stage, key in threads:
+                frame = frames.get(ident)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + 
+                                 str(code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                names.append(str(key) if key is not None else "-")
+                names.append(stage)
+                stack = ";".join(reversed(names))
+                with self._lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def get_data(self):
+        """Returns the data of the profiler, e.g. to send from another process. See merge().
+        """
+        with self._lock:
+            return {'sections': dict(self.sections), 'stacks': dict(self.stacks)}
+
+    def merge(self, data):
+        """Adds the data from get_data() of another profiler.
+        """
+        for (stage, key), (seconds, count, all_stats) in data['sections'].iteritems():
+            self._add(stage, key, seconds, count, all_stats)
+        with self._lock:
+            for stack, samples in data['stacks'].iteritems():
+                self.stacks[stack] = self.stacks.get(stack, 0) + samples
+
+    def get_stats(self, stream=None):
+        """Returns a pstats.Stats with the cProfile stats of all the sections, or None if there are 
+        no stats.
+        """
+        stats = None
+        with self._lock:
+            all_stats = [item for data in self.sections.values() for item in data[2]]
+        for item in all_stats:
+            if stats is None:
+                stats = pstats.Stats(_StatsHolder(item), stream=stream)
+            else:
+                stats.add(_StatsHolder(item))
+        return stats
+
+    def get_report(self, count=20):
+        """Returns a str with three tables: the time in each stage, the zotero keys with the most 
+        time (summed over all stages), and the functions with the most time (not counting the 
+        functions that they call).
+        """
+        stages = {}
+        keys = {}
+        with self._lock:
+            sections = self.sections.items()
+        for (stage, key), (seconds, num, _) in sections:
+            stage_data = stages.setdefault(stage, [0.0, 0])
+            stage_data[0] += seconds
+            stage_data[1] += num
+            if key is not None:
+                key_data = keys.setdefault(key, [0.0, set()])
+                key_data[0] += seconds
+                key_data[1].add(stage)
+        lines = ["%-10s %8s %10s" % ('stage', 'sections', 'seconds')]
+        for stage, (seconds, num) in sorted(stages.items(), key=lambda item: -item[1][0]):
+            lines.append("%-10s %8d %10.3f" % (stage, num, seconds))
+        lines.extend(["", "Most expensive zotero keys:"])
+        keys = sorted(keys.items(), key=lambda item: -item[1][0])
+        for key, (seconds, key_stages) in keys[:count]:
+            lines.append("  %10.3f  %-12s %s" % (seconds, key, ", ".join(sorted(key_stages))))
+        lines.extend(["", "Most expensive functions:"])
+        stream = StringIO()
+        stats = self.get_stats(stream)
+        if stats is not None:
+            stats.strip_dirs().sort_stats('tottime').print_stats(count)
+        lines.append(stream.getvalue())
+        return "\n".join(lines)
+
+    def write(self, filepath_prefix, count=20):
+        """Writes the report to filepath_prefix + '.txt', the collapsed stacks (one stack per line, 
+        the frames separated by ';', followed by the number of samples) to filepath_prefix + 
+        '.collapsed', and the cProfile stats to filepath_prefix + '.pstats'. Returns the list of 
+        the file paths.
+        """
+        filepaths = [filepath_prefix + '.txt', filepath_prefix + '.collapsed']
+        with open(filepaths[0], 'w') as report_file:
+            report_file.write(self.get_report(count))
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        with open(filepaths[1], 'w') as stacks_file:
+            for stack, samples in stacks:
+                stacks_file.write(stack + " " + str(samples) + "\n")
+        stats = self.get_stats()
+        if stats is not None:
+            filepaths.append(filepath_prefix + '.pstats')
+            stats.dump_stats(filepaths[2])
+        return filepaths
+
+
+class _Section(object):
+    """The context manager returned by BuildProfiler.profile().
+    """
+    def __init__(self, profiler, stage, key):
+        self.profiler = profiler
+        self.stage = stage
+        self.key = key
+        self._section = None
+        self._start = None
+
+    def __enter__(self):
+        self._section = self.profiler._open_section(self.stage, self.key)
+        self._start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.profiler._close_section(self._section, time.time() - self._start)
+
+
+class _NoSection(object):
+    """A context manager that does nothing, used when there is no profiler.
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _StatsHolder(object):
+    """Holds a cProfile stats dict, so that it can be loaded by pstats.Stats.
+    """
+    def __init__(self, stats):
+        self.stats = dict(stats)
+
+    def create_stats(self):
+        pass
+
+# ================================================================================================
+# Utility functions to profile parts of the code, if there is a profiler
+# ================================================================================================
+
+def _remove_profiler_funcs(stats):
+    """Removes the functions of cProfile (see PROFILER_FUNCS) from a cProfile stats dict. Returns 
+    the stats dict.
+    """
+    for func in stats.keys():
+        if func[2] in PROFILER_FUNCS:
+            del stats[func]
+    for func, (cc, nc, tt, ct, callers) in stats.iteritems():
+        for caller in callers.keys():
+            if caller[2] in PROFILER_FUNCS:
+                del callers[caller]
+    return stats
+
+def profile(profiler, stage, key=None):
+    """Returns profiler.profile(stage, key), or a context manager that does nothing if the 
+    profiler is None.
+    """
+    if profiler is None:
+        return _NoSection()
+    return profiler.profile(stage, key)
+
+def map_profiled(profiler, pool, func, stage, keys, args):
+    """Calls func for each of the args and returns the list of results, like map(). If the pool is
+    None, the calls are made in this process, else with pool.map(). If there is a profiler, each 
+    call is profiled as a section, with the stage and the key for that call. In other processes, a
+    new profiler is used for each call, and its data is merged into the profiler.
+    """
+    if pool is None:
+        results = []
+        for key, arg in zip(keys, args):
+            with profile(profiler, stage, key):
+                results.append(func(arg))
+        return results
+    if profiler is None:
+        return pool.map(func, args)
+    results = []
+    jobs = [(func, stage, key, arg) for key, arg in zip(keys, args)]
+    for result, data in pool.map(_call_profiled, jobs):
+        profiler.merge(data)
+        results.append(result)
+    return results
+
+def _call_profiled(job):
+    """Calls a function with a new profiler, in another process. The job is a tuple: (func, stage,
+    key, arg). Returns a tuple: (result, data), where data is the data of the profiler.
+    """
+    func, stage, key, arg = job
+    profiler = BuildProfiler()
+    profiler.start()
+    try:
+        with profiler.profile(stage, key):
+            result = func(arg)
+    finally:
+        profiler.stop()
+    return result, profiler.get_data()
@@ -0,0 +1,239 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A structured report of a build. Each thing that happens is a BuildEvent, and the events are 
+written to sinks as they happen: a human readable log, a json lines file, or a summary table.
+"""
+
+import sys
+import json
+import time
+import threading
+import traceback
+
+from build_metrics import get_metrics
+
+# ================================================================================================
+# Events
+# ================================================================================================
+
+class BuildEvent(object):
+    """Something that happened during a build. The stage is the part of the build, e.g. 'tab', 
+    'render', 'image', 'resize' or 'download'. The key is the zotero key or the file name of the 
+    thing that the event is about. The duration is in seconds, num_bytes is the number of bytes 
+    that were transferred or written, cache is 'hit' or 'miss', and error is the traceback (or a 
+    message) if something went wrong. The level is the indent in the human readable log.
+
+    The events only contain simple values, so they can be pickled and sent from another process.
+    """
+    def __init__(self, stage, message, key=None, duration=None, num_bytes=None, cache=None, 
+                 error=None, level=0):
+        self.time = time.time()
+        self.stage = stage
+        self.message = message
+        self.key = key
+        self.duration = duration
+        self.num_bytes = num_bytes
+        self.cache = cache
+        self.error = error
+        self.level = level
+
+    def to_dict(self):
+        """Returns a dict with the data of the event, e.g. to save as json.
+        """
+        return {'time': self.time, 'stage': self.stage, 'message': self.message, 'key': self.key,
+                'duration': self.duration, 'bytes': self.num_bytes, 'cache': self.cache, 
+                'error': self.error}
+
+    def __str__(self):
+        """A human readable str, indented by the level, with the details in brackets.
+        """
+        details = []
+        if self.key is not None:
+            details.append(str(self.key))
+        if self.duration is not None:
+            details.append("%.3fs" % self.duration)
+        if self.num_bytes is not None:
+            details.append(str(self.num_bytes) + " bytes")
+        if self.cache is not None:
+            details.append("cache " + self.cache)
+        event_str = "  " * self.level
+        if self.error is not None:
+            event_str += "ERROR: "
+        event_str += self.message
+        if details:
+            event_str += " (" + ", ".join(details) + ")"
+        if self.error is not None and self.error != self.message:
+            event_str += "\nEXCEPTION: \n" + self.error
+        return event_str
+
+# ================================================================================================
+# Report
+# ================================================================================================
+
+class BuildReport(object):
+    """The events of a build. The events are kept in a list, and written to each of the sinks as 
+    they are added. A sink is an object with a write(event) method and a close() method. Events 
+    can be added from many threads at the same time. The errors are counted in the metrics.
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, message, key=None, duration=None, num_bytes=None, cache=None, 
+            error=None, level=0):
+        """Adds an event, see BuildEvent. Returns the event.
+        """
+        event = BuildEvent(stage, message, key, duration, num_bytes, cache, error, level)
+        self.add_event(event)
+        return event
+
+    def add_error(self, stage, message, key=None, level=0):
+        """Adds an event for an exception. This must be called while handling the exception, the
+        traceback is saved as the error. Returns the event.
+        """
+        return self.add(stage, message, key, error=traceback.format_exc(), level=level)
+
+    def add_event(self, event):
+        """Adds an event, e.g. an event that was created in another process.
+        """
+        if event.error is not None:
+            get_metrics().inc('webtero_build_errors_total', stage=event.stage)
+        with self._lock:
+            self.events.append(event)
+            for sink in self.sinks:
+                sink.write(event)
+
+    def get_errors(self):
+        """Returns the list of events that are errors.
+        """
+        return [event for event in self.events if event.error is not None]
+
+    def close(self):
+        """Closes all the sinks.
+        """
+        for sink in self.sinks:
+            sink.close()
+
+    def __str__(self):
+        """The human readable log of all the events.
+        """
+        return "\n".join(str(event) for event in self.events)
+
+# ================================================================================================
+# Sinks
+# ================================================================================================
+
+class LogSink(object):
+    """Writes each event to a stream as a human readable line, by default to stdout.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, event):
+        stream = self.stream or sys.stdout
+        stream.write(str(event) + "\n")
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink(object):
+    """Writes each event to a file as a line of json. New events are added to the end of the file.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'a')
+
+    def write(self, event):
+        self._file.write(json.dumps(event.to_dict(), sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SummarySink(object):
+    """Collects the events, and when it is closed, writes a summary table to a stream (by default 
+    stdout): the totals for each stage, the slowest tabs and images, and the total build time. 
+
+    Only the events that have a key (the events about one tab, image, file, etc.) are summed for 
+    each stage, since the events without a key are themselves totals. The seconds for a stage are 
+    the sum over all the threads and processes, so they can be more than the wall clock time. The 
+    total build time is the sum of the durations of the top level events.
+    """
+    # The stages that are summed for each tab and each image
+    TAB_STAGES = ('tab', 'render')
+    IMAGE_STAGES = ('image', 'resize')
+
+    def __init__(self, count=10, stream=None):
+        self.count = count
+        self.stream = stream
+        self.events = []
+
+    def write(self, event):
+        self.events.append(event)
+
+    def close(self):
+        stream = self.stream or sys.stdout
+        stream.write(self.get_summary() + "\n")
+        stream.flush()
+
+    def get_summary(self):
+        """Returns the summary table as a str.
+        """
+        lines = ["%-10s %8s %10s %12s %6s %6s %6s" % (
+            'stage', 'events', 'seconds', 'bytes', 'hits', 'misses', 'errors')]
+        stages = []
+        for event in self.events:
+            if event.stage not in stages:
+                stages.append(event.stage)
+        for stage in stages:
+            events = [event for event in self.events 
+                      if event.stage == stage and event.key is not None]
+            if not events:
+                continue
+            lines.append("%-10s %8d %10.3f %12d %6d %6d %6d" % (
+                stage, len(events), sum(event.duration or 0 for event in events), 
+                sum(event.num_bytes or 0 for event in events), 
+                len([event for event in events if event.cache == 'hit']), 
+                len([event for event in events if event.cache == 'miss']), 
+                len([event for event in events if event.error is not None])))
+        lines.extend(self._get_slowest("Slowest tabs", self.TAB_STAGES))
+        lines.extend(self._get_slowest("Slowest images", self.IMAGE_STAGES))
+        total = sum(event.duration or 0 for event in self.events if event.level == 0)
+        lines.extend(["", "Total build time: %.3fs" % total])
+        return "\n".join(lines)
+
+    def _get_slowest(self, title, stages):
+        """Returns the lines of a table of the keys with the longest total duration in the stages.
+        """
+        durations = {}
+        for event in self.events:
+            if event.stage in stages and event.key is not None:
+                durations[event.key] = durations.get(event.key, 0) + (event.duration or 0)
+        slowest = sorted(durations.items(), key=lambda item: item[1], reverse=True)
+        lines = ["", title + ":"]
+        for key, duration in slowest[:self.count]:
+            lines.append("  %10.3f  %s" % (duration, key))
+        return lines
@@ -0,0 +1,249 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A long running process that keeps websites up to date with the data in zotero.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+from zotero_reader import get_path_group, invalidate_group
+from website_generator import TabbedWebsite
+from build_report import BuildReport, JsonLinesSink, LogSink
+from build_metrics import get_metrics
+from build_profile import BuildProfiler
+
+# The number of seconds between polls of the zotero groups
+POLL_INTERVAL = 60
+
+# ================================================================================================
+# Site
+# ================================================================================================
+
+class WebsiteConfig(object):
+    """The settings for one website, see TabbedWebsite. The settings can be read from a dict, 
+    e.g. from a json file, with from_dict().
+    """
+    def __init__(self, website_coll, template_coll, images_coll, website_filepath, images_url, 
+                 images_dirpath, workers=8, processes=None):
+        self.website_coll = website_coll
+        self.template_coll = template_coll
+        self.images_coll = images_coll
+        self.website_filepath = website_filepath
+        self.images_url = images_url
+        self.images_dirpath = images_dirpath
+        self.workers = workers
+        self.processes = processes
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a config from a dict, the keys are the names of the arguments of __init__.
+        """
+        return cls(**dict((str(key), value) for key, value in data.iteritems()))
+
+    def get_group_paths(self):
+        """Returns the zotero paths that this website is created from.
+        """
+        return [self.website_coll, self.template_coll, self.images_coll]
+
+    def get_name(self):
+        """Returns a name for the website that can be used in file names.
+        """
+        return re.sub(r'[^A-Za-z0-9]+', '_', self.website_coll).strip('_')
+
+    def create_website(self, report, profiler=None):
+        """Creates the website. The files that have not changed since the last build are skipped, 
+        see TabbedWebsite.create_website(). The events are added to the report. If there is a 
+        profiler, the build is profiled. TabbedWebsite adds its errors to the report instead of 
+        raising them, so returns True if no errors were added to the report, else False.
+        """
+        num_errors = len(report.get_errors())
+        website = TabbedWebsite(self.website_coll, self.template_coll, self.images_coll, 
+                                self.workers, self.processes, report=report, profiler=profiler)
+        website.initialize_data()
+        website.create_website(self.website_filepath, self.images_url, self.images_dirpath)
+        return len(report.get_errors()) == num_errors
+
+    def __str__(self):
+        return self.website_coll
+
+# ================================================================================================
+# Daemon
+# ================================================================================================
+
+class WebsiteDaemon(object):
+    """Keeps a list of websites up to date. Every poll_interval seconds, the library version of each 
+    zotero group is checked, which is a single small request. If the version has changed, the 
+    group is synced with only the changes, and the websites that use that group are created again.
+
+    The groups, the downloaded data, and the connections are kept in memory between polls, so a 
+    build after a small change only downloads and renders what has changed.
+
+    The events are added to the report, by default a BuildReport that writes them to stdout. If
+    there is a metrics_filepath, the metrics are written to it after each poll, see 
+    MetricsRegistry.write(). If there is a profile_dirpath, each build is profiled, and the 
+    profile is written to that directory, see BuildProfiler.write().
+    """
+    def __init__(self, configs, poll_interval=POLL_INTERVAL, report=None, 
+                 metrics_filepath=None, profile_dirpath=None):
+        self.configs = configs
+        self.poll_interval = poll_interval
+        self.report = report if report is not None else BuildReport([LogSink()])
+        self.metrics_filepath = metrics_filepath
+        self.profile_dirpath = profile_dirpath
+        # The websites that need to be created, the first time all of them
+        self.stale = set(range(len(configs)))
+        self.cycles = 0
+
+    def poll(self):
+        """Syncs each zotero group that is used by the websites, and marks the websites that use a 
+        group that has changed as stale. If a group could not be synced, it is removed from the 
+        group registry, so that it is connected to again, and its websites are marked as stale. 
+        The events are added to the report.
+        """
+        self.report.add('sync', "Polling zotero groups.")
+        groups = {}
+        for index, config in enumerate(self.configs):
+            try:
+                for group_path in config.get_group_paths():
+                    group = get_path_group(group_path)
+                    groups.setdefault(id(group), (group, set()))[1].add(index)
+            except Exception:
+                self.report.add_error('sync', "Could not get the groups for '" + str(config) + "'.")
+                self.stale.add(index)
+        for group, indexes in groups.values():
+            start = time.time()
+            version = group.version
+            lines = group.sync().strip().splitlines()
+            if group.sync_error is not None:
+                self.report.add('sync', "Could not sync the group '" + group.name + "'.", 
+                                group.uid, time.time() - start, error=group.sync_error, level=1)
+                invalidate_group(group.name, group.zot_id, group.zot_key)
+                self.stale.update(indexes)
+                continue
+            for line in lines[:-1]:
+                self.report.add('sync', line.strip(), level=1)
+            self.report.add('sync', lines[-1].strip(), group.uid, time.time() - start, level=1)
+            if group.version != version:
+                self.stale.update(indexes)
+
+    def build(self):
+        """Creates the stale websites. If a website fails, it stays stale and is tried again after 
+        the next poll. The events are added to the report.
+        """
+        for index in sorted(self.stale):
+            config = self.configs[index]
+            self.report.add('website', "Creating the '" + str(config) + "' website.")
+            profiler = None
+            if self.profile_dirpath:
+                profiler = BuildProfiler()
+                profiler.start()
+            try:
+                if config.create_website(self.report, profiler):
+                    self.stale.discard(index)
+            except Exception:
+                self.report.add_error('website', "Could not create the website.")
+            if profiler is not None:
+                self._write_profile(config, profiler)
+
+    def _write_profile(self, config, profiler):
+        """Stops the profiler and writes the profile of a build to the profile_dirpath.
+        """
+        profiler.stop()
+        filepath_prefix = os.path.join(self.profile_dirpath, config.get_name())
+        try:
+            filepaths = profiler.write(filepath_prefix)
+            self.report.add('website', "Wrote the profile: " + ", ".join(filepaths))
+        except Exception:
+            self.report.add_error('website', "Could not write the profile.", filepath_prefix)
+
+    def run_once(self):
+        """Polls the groups and creates the stale websites, and then writes the metrics. The 
+        first time, all the websites are created without polling.
+        """
+        if self.cycles > 0:
+            self.poll()
+        self.build()
+        self.cycles += 1
+        if self.metrics_filepath:
+            try:
+                get_metrics().write(self.metrics_filepath)
+            except Exception:
+                self.report.add_error('website', "Could not write the metrics.", 
+                                      self.metrics_filepath)
+
+    def run(self, cycles=None):
+        """Polls and builds until stopped with ctrl-c, or for a number of cycles. 
+        """
+        cycle = 0
+        try:
+            while cycles is None or cycle < cycles:
+                start = time.time()
+                self.run_once()
+                cycle += 1
+                if cycles is None or cycle < cycles:
+                    time.sleep(max(0, self.poll_interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            self.report.add('website', "Stopped.")
+
+# ================================================================================================
+# Utility function to read the websites from a json file
+# ================================================================================================
+
+def read_configs(filepath):
+    """Reads a json file with a list of websites. Each website is a dict of settings, see 
+    WebsiteConfig.
+    """
+    with open(filepath, 'r') as config_file:
+        return [WebsiteConfig.from_dict(data) for data in json.load(config_file)]
+
+# ================================================================================================
+# Main
+# ================================================================================================
+
+if __name__ == "__main__":
+    # The --profile=dirpath option can be anywhere, the other args are in order
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--profile=')]
+    profile_dirpath = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--profile='):
+            profile_dirpath = arg[len('--profile='):]
+    if len(args) < 1:
+        print "Usage: website_daemon.py [--profile=dir] websites.json [poll] [events] [metrics]"
+        sys.exit(1)
+    interval = POLL_INTERVAL
+    if len(args) > 1:
+        interval = float(args[1])
+    sinks = [LogSink()]
+    if len(args) > 2 and args[2]:
+        sinks.append(JsonLinesSink(args[2]))
+    metrics_filepath = None
+    if len(args) > 3:
+        metrics_filepath = args[3]
+    print "Starting website daemon"
+    report = BuildReport(sinks)
+    try:
+        WebsiteDaemon(read_configs(args[0]), interval, report, metrics_filepath, 
+                      profile_dirpath).run()
+    finally:
+        report.close()
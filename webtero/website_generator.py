@@ -24,18 +24,32 @@
 
 # Built in python libs
 import os
+import time
+import shutil
+import tempfile
 import traceback
-import urllib
-from urlparse import urlparse
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 # Third party libs
-from pyzotero import zotero
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup
 from PIL import Image
-import jinja2
+
+# The widths of the extra image files created for each image, used in the srcset of the <img>
+IMAGE_WIDTHS = (320, 640, 960, 1280, 1920)
+# The extra formats of the image files created for each image, used in <source> tags
+IMAGE_FORMATS = ('webp',)
 
 # My libs
 from zotero_reader import get_collection
+from zotero_files import get_downloader
+from website_templates import get_attachment_template, get_string_template
+from build_manifest import BuildManifest, get_manifest_filepath
+from build_report import BuildEvent, BuildReport, LogSink, SummarySink
+from build_metrics import get_metrics
+from build_profile import map_profiled, profile
 
 # ================================================================================================
 # The main classes to make the website.
@@ -57,217 +71,682 @@ class TabbedWebsite(object):
     website_filepath: The location on disk where to save html file (including the filename).
     images_dirpath: The location on disk where to save downloaded images.
     images_url: The url to use for images.
+
+    The tabs are processed in parallel. The data for the tabs is downloaded and parsed using a pool
+    of threads (workers), and the tabs are rendered using a pool of processes (processes). If 
+    processes is 1, the tabs are rendered in this process. If processes is None (the default), 
+    the number of cpus is used.
+
+    For each image, extra files are created with the image_widths (smaller than the original) and 
+    in the image_formats (e.g. webp), so that browsers can choose the best file.
+
+    What happens during the build is added to the report, a BuildReport. If no report is given, 
+    the events are only kept in memory, in self.report.
+
+    If a profiler (a BuildProfiler) is given, initialize_data() and create_website() are profiled,
+    with a section for each tab, rendered tab, image and resized image, keyed by zotero key.
     
     """
-    def __init__(self, website_coll, template_coll, images_coll):
+    def __init__(self, website_coll, template_coll, images_coll, workers=8, processes=None, 
+                 image_widths=IMAGE_WIDTHS, image_formats=IMAGE_FORMATS, report=None, 
+                 profiler=None):
         #Zotero collections
         self.website_coll = website_coll
         self.template_coll = template_coll
         self.images_coll = images_coll
+        #The image files
+        self.image_widths = image_widths
+        self.image_formats = image_formats
+        #The executors
+        self.workers = workers
+        self.processes = processes or multiprocessing.cpu_count()
         #The data
-        self.template_str = None
+        self.template = None
+        self.template_attachment = None
         self.head = None
         self.tabs = []
+        self.fragments = None
         self.zot_images = None
+        #The report of the build
+        self.report = report if report is not None else BuildReport()
+        self.profiler = profiler
 
     def initialize_data(self):
-        """Get the data from the zotero database.
+        """Get the data from the zotero database. The events are added to the report.
         """
-        info_str = "Creating data for the " + self.website_coll + " website.\n"
+        with profile(self.profiler, 'data'):
+            self._initialize_data()
+
+    def _initialize_data(self):
+        """Get the data from the zotero database, see initialize_data().
+        """
+        report = self.report
+        start = time.time()
+        report.add('data', "Creating data for the " + self.website_coll + " website.")
 
         # Get the content
         try:
             coll = get_collection(self.website_coll)
             items = coll.get_items() #various items, e.g. documents
         except Exception:
-            info_str += "ERROR: could not get sub-collections: '" + self.website_coll + "'.\n"
-            info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
-            return info_str
+            report.add_error('data', "Could not get sub-collections: '" + self.website_coll + "'.")
+            return
         if not items:
-            info_str += "ERROR: could not find any items to create tabs from.\n"
-            return info_str
+            report.add('data', "Could not find any items to create tabs from.", 
+                       error="No items were found.")
+            return
 
         # Get the images
         try:
             img_coll = get_collection(self.images_coll)
             self.zot_images = img_coll.get_image_attachments()
-            for i in self.zot_images:
-                print i.__dict__
         except Exception:
-            info_str += "ERROR: could not get sub-collections: '" + self.images_coll + "'.\n"
-            info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
-            return info_str
+            report.add_error('data', "Could not get sub-collections: '" + self.images_coll + "'.")
+            return
 
         # Get the template (i.e. the first html in the list of html attachments)
+        # The template and the html attachments of all the tabs are first downloaded in parallel
         try:
             files_coll = get_collection(self.template_coll)
             html_files = files_coll.get_html_attachments()
-            self.template_str = html_files[0].get_file_data() # The template is assumed to be the first html file
+            tabs_html_files = self._get_html_attachments(items)
+            prefetch_attachments(report, html_files[:1] + tabs_html_files, 1, self.profiler)
+            self.template_attachment = html_files[0] # The template is assumed to be the first html file
+            self.template = get_attachment_template(self.template_attachment)
         except Exception:
-            info_str += "ERROR: could not get sub-collections: '" + self.template_coll + "'.\n"
-            info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
-            return info_str
+            report.add_error('data', "Could not get sub-collections: '" + self.template_coll + "'.")
+            return
         if not html_files:
-            info_str += "ERROR: could not find an html template file.\n"
-            return info_str
+            report.add('data', "Could not find an html template file.", 
+                       error="No template was found.")
+            return
 
         # Get the head item and create the tabs from the other items
         for item in items:
             if item.title == 'Head':
                 self.head = item
             else:
-                tab = WebTab(item)
-                info_str += tab.initialize_data()
-                self.tabs.append(tab)
+                self.tabs.append(WebTab(item))
+        self._initialize_tabs()
         self.tabs.sort(key=lambda item: item.sort_key) # sort key is the Call Number
         if not self.head:
-            info_str += "ERROR: Head was not found.\n"
+            report.add('data', "Head was not found.", error="No Head was found.")
             self.html_str = "No Head was found."
         if not self.tabs:
-            info_str += "ERROR: no tabs were found.\n"
+            report.add('data', "No tabs were found.", error="No html tabs were found.")
             self.html_str = "No html tabs were found."
-        return info_str
+        report.add('data', "Created data for " + str(len(self.tabs)) + " tabs.", 
+                   duration=time.time() - start)
+        _observe_build('data', time.time() - start)
+
+    def _get_html_attachments(self, items):
+        """Returns the html attachments of all the items. Getting the attachments of an item may 
+        need a request to zotero, so the items are done using a pool of threads.
+        """
+        if self.workers <= 1 or len(items) <= 1:
+            items_html_files = [item.get_html_attachments() for item in items]
+        else:
+            pool = ThreadPool(min(self.workers, len(items)))
+            try:
+                items_html_files = pool.map(_get_html_attachments, items)
+            finally:
+                pool.close()
+        return [att for html_files in items_html_files for att in html_files]
+
+    def _initialize_tabs(self):
+        """Initialize the data for all the tabs, using a pool of threads.
+        """
+        tab_args = [(tab, self.report, self.profiler) for tab in self.tabs]
+        if self.workers <= 1 or len(self.tabs) <= 1:
+            for args in tab_args:
+                _initialize_tab(args)
+            return
+        pool = ThreadPool(min(self.workers, len(self.tabs)))
+        try:
+            pool.map(_initialize_tab, tab_args)
+        finally:
+            pool.close()
+
+    def _render_tabs(self, images_url, manifest=None):
+        """Renders the button and the content of each tab, and saves them in self.fragments, in
+        the same order as the tabs. If there is a manifest, the fragments of the tabs whose inputs
+        have not changed are taken from the manifest, and only the other tabs are rendered. The 
+        tabs are rendered using a pool of processes. An event is added to the report for each tab.
+        """
+        start = time.time()
+        self.fragments = [None] * len(self.tabs)
+        all_inputs = [None] * len(self.tabs)
+        render_indexes = []
+        for i, tab in enumerate(self.tabs):
+            if manifest is not None:
+                all_inputs[i] = tab.get_render_inputs(images_url)
+                if all_inputs[i] is not None:
+                    self.fragments[i] = manifest.get_fragment(tab.item.uid, all_inputs[i])
+            if self.fragments[i] is None:
+                render_indexes.append(i)
+        render_args = [self.tabs[i].get_render_args(images_url) for i in render_indexes]
+        keys = [self.tabs[i].item.uid for i in render_indexes]
+        if self.processes <= 1 or len(render_args) <= 1:
+            results = map_profiled(self.profiler, None, _render_tab, 'render', keys, render_args)
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(render_args)))
+            try:
+                results = map_profiled(self.profiler, pool, _render_tab, 'render', keys, 
+                                       render_args)
+            finally:
+                pool.close()
+                pool.join()
+        metrics = get_metrics()
+        for i, (content, duration) in zip(render_indexes, results):
+            metrics.inc('webtero_tabs_rendered_total', result='rendered')
+            metrics.observe('webtero_tab_render_duration_seconds', duration)
+            tab = self.tabs[i]
+            self.fragments[i] = {'button': tab.get_button_html(), 'content': content}
+            if all_inputs[i] is not None:
+                manifest.set_fragment(tab.item.uid, all_inputs[i], self.fragments[i])
+            self.report.add('render', "Rendered the '" + tab.name + "' tab.", tab.item.uid, 
+                            duration, len(content), 'miss', level=2)
+        for i, tab in enumerate(self.tabs):
+            if i not in render_indexes:
+                self.report.add('render', "The '" + tab.name + "' tab was up to date.", 
+                                tab.item.uid, cache='hit', level=2)
+        metrics.inc('webtero_tabs_rendered_total', len(self.tabs) - len(render_indexes), 
+                    result='cached')
+        if manifest is not None:
+            manifest.prune_fragments([tab.item.uid for tab in self.tabs])
+        self.report.add('render', "Rendered " + str(len(render_indexes)) + " tabs, " + 
+                        str(len(self.tabs) - len(render_indexes)) + " tabs were up to date.", 
+                        duration=time.time() - start, level=1)
 
     def _get_buttons_html(self):
-        """Get an html string for the tab buttons. The html is encoded as utf-8.
+        """Get an html string for the tab buttons. The html is encoded as utf-8. The tabs must have
+        been rendered.
         """
-        return "".join([tab.get_button_html() for tab in self.tabs])
+        return "".join([fragment['button'] for fragment in self.fragments])
 
-    def _get_content_html(self, images_url):
-        """Get an html string for the content of all the tabs. The html is encoded as utf-8.
+    def _get_content_html(self):
+        """Get an html string for the content of all the tabs. The html is encoded as utf-8. The 
+        tabs must have been rendered.
         """
-        return "".join([tab.get_content_html(images_url) for tab in self.tabs])
+        return "".join([fragment['content'] for fragment in self.fragments])
 
     def _get_html(self, images_url):
         """Returns the full html for a web page with tabs. The template is a jinja2 template that 
         is attached to the item called Head (should be only one). The html is encoded as utf-8.
+        The page is assembled from the tab fragments, the tabs are rendered if needed.
         """
+        if self.fragments is None:
+            self._render_tabs(images_url)
         tabs_buttons = self._get_buttons_html().decode('utf-8')
-        tabs_content = self._get_content_html(images_url).decode('utf-8')
-        jinja_template = jinja2.Template(self.template_str.decode('utf-8'))
-        return jinja_template.render(
+        tabs_content = self._get_content_html().decode('utf-8')
+        return self.template.render(
             head=self.head, buttons=tabs_buttons, content=tabs_content).encode('utf-8')
     
-    def _create_image_files(self, images_dirpath):
-        """Create the image files for the website.
+    def _create_image_files(self, images_dirpath, manifest=None):
+        """Create the image files for the website. If there is a manifest, only the image files 
+        that have changed are created.
         """
-        info_str = "  Creating image files.\n"
+        start = time.time()
         # Get all the images in all web page tabs
         all_image_tags = []
         for tab in self.tabs:
             all_image_tags.extend(tab.html_content.image_tags.values())
         # Create the image object and ask it to generate the files
-        images = Images(all_image_tags, images_dirpath, self.zot_images)
-        info_str += images.create_image_files()
-        return info_str
+        images = Images(all_image_tags, images_dirpath, self.zot_images, self.processes, 
+                        self.image_widths, self.image_formats, manifest, self.report, 
+                        self.profiler)
+        images.create_image_files()
+        self.report.add('images', "Created the image files for " + str(len(all_image_tags)) + 
+                        " images.", duration=time.time() - start, level=1)
 
-    def _create_html_file(self, website_filepath, images_url):
+    def _get_html_inputs(self, images_url):
+        """Returns the inputs that the html file is created from, for the manifest: the versions of 
+        the template, the head (None if there is no head) and the tabs, and the names and sizes of 
+        the images. Returns None if the version of any of the files is not known.
+        """
+        head = None
+        if self.head:
+            head = [self.head.uid, self.head.version]
+        inputs = {
+            'template': [self.template_attachment.uid, self.template_attachment.get_file_tag()],
+            'head': head,
+            'tabs': [],
+            'images': [],
+            'images_url': images_url}
+        for tab in self.tabs:
+            html_attachment = tab.html_content.html_attachment
+            inputs['tabs'].append([tab.item.uid, tab.item.version, html_attachment.uid, 
+                                   html_attachment.get_file_tag()])
+            for image_tag in tab.html_content.image_tags.values():
+                inputs['images'].append([image_tag.original_name, image_tag.new_name, 
+                                         image_tag.display_size, image_tag.variants])
+        inputs['images'].sort()
+        if inputs['template'][1] is None or None in [tab[3] for tab in inputs['tabs']]:
+            return None
+        return inputs
+
+    def _create_html_file(self, website_filepath, images_url, manifest=None):
         """Create an html file. Filename includes the full path to the file. Any folders must
-        exist. The html is encoded as utf-8.
+        exist. The html is encoded as utf-8. If there is a manifest and none of the inputs have 
+        changed, the file is not created again.
         """
-        info_str = "  Creating html file.\n"
-        with open(website_filepath, 'w') as html_file:
-            html_file.write(self._get_html(images_url))
-        return info_str
+        start = time.time()
+        inputs = None
+        if manifest is not None:
+            inputs = self._get_html_inputs(images_url)
+            if inputs is not None and manifest.is_current(website_filepath, inputs):
+                self.report.add('html', "The html file was up to date.", website_filepath, 
+                                cache='hit', level=1)
+                return
+        self._render_tabs(images_url, manifest)
+        html_str = self._get_html(images_url)
+        temp_filepath = _get_temp_filepath(website_filepath)
+        with open(temp_filepath, 'w') as html_file:
+            html_file.write(html_str)
+        os.rename(temp_filepath, website_filepath)
+        if inputs is not None:
+            manifest.update(website_filepath, inputs)
+        self.report.add('html', "Created the html file.", website_filepath, time.time() - start, 
+                        len(html_str), 'miss', level=1)
 
     def create_website(self, website_filepath, images_url, images_dirpath):
-        """Create all the files for the website.
+        """Create all the files for the website. A manifest of the files is saved next to the html
+        file, so that the next time only the files that have changed are created. The events are 
+        added to the report.
+        """
+        with profile(self.profiler, 'website'):
+            self._create_website(website_filepath, images_url, images_dirpath)
+
+    def _create_website(self, website_filepath, images_url, images_dirpath):
+        """Create all the files for the website, see create_website().
         """
-        info_str = "Writing files to disk: " + website_filepath + "\n"
+        start = time.time()
+        self.report.add('website', "Writing files to disk: " + website_filepath)
+        manifest = BuildManifest(get_manifest_filepath(website_filepath))
         try:
-            info_str += self._create_image_files(images_dirpath)
-            info_str += self._create_html_file(website_filepath, images_url)
+            self._create_image_files(images_dirpath, manifest)
+            self._create_html_file(website_filepath, images_url, manifest)
         except Exception:
-            info_str += "ERROR: could not write files to disk. \n"
-            info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
-        return info_str
+            self.report.add_error('website', "Could not write files to disk.")
+        finally:
+            manifest.save()
+        self.report.add('website', "Created the website.", website_filepath, time.time() - start)
+        _observe_build('website', time.time() - start)
 
 
 
 
 class Images(object):
-    """A class for writing the image files. 
+    """A class for writing the image files. The resized images are created using a pool of 
+    processes. If processes is 1, they are created in this process. For each image, the extra
+    files for the image widths and formats are also created (see HtmlImageTag.set_variants).
+
+    If there is a BuildManifest, an image file is only created if the file it is created from has 
+    changed. Otherwise, an image file is only created if it does not exist. The events are added 
+    to the report, a BuildReport. If there is a profiler, each image and each resize job is 
+    profiled, keyed by the zotero key of the attachment (or by the name, if it is not in zotero).
     """
-    def __init__(self, image_tags, images_dirpath, zot_attachments):
+    def __init__(self, image_tags, images_dirpath, zot_attachments, processes=1, 
+                 image_widths=(), image_formats=(), manifest=None, report=None, profiler=None):
         # The item that represents this tab
         self.image_tags = image_tags
         self.images_dirpath = images_dirpath
         self.zot_attachments = zot_attachments
+        self.processes = processes
+        self.image_widths = image_widths
+        self.image_formats = image_formats
+        self.manifest = manifest
+        self.report = report if report is not None else BuildReport()
+        self.profiler = profiler
+        self._resize_jobs = {}
+        self._resize_inputs = {}
+        self._resize_keys = {}
+        self._names = {}
+        self._duplicate_names = {}
+        self._index_attachments()
+
+    def _index_attachments(self):
+        """Creates the dict of attachments, keyed by name. Each attachment is added under its 
+        filename and its title. If a name is used by more than one attachment, a filename match 
+        wins over a title match, and otherwise the first attachment wins. The names that are used 
+        by more than one attachment are saved in a dict of duplicates, name -> list of attachments.
+        """
+        filenames = {}
+        titles = {}
+        for att in self.zot_attachments:
+            for name, names in ((getattr(att, 'filename', None), filenames), 
+                                (getattr(att, 'title', None), titles)):
+                if name:
+                    names.setdefault(name, []).append(att)
+        for names in (titles, filenames):
+            for name, atts in names.iteritems():
+                self._names[name] = atts[0]
+        for name in set(filenames).union(titles):
+            atts = filenames.get(name, []) + titles.get(name, [])
+            if len(set([att.uid for att in atts])) > 1:
+                self._duplicate_names[name] = atts
+
+    def _add_duplicates_warnings(self):
+        """Adds a warning to the report for each image name that is used by more than one 
+        attachment.
+        """
+        names = set([image_tag.original_name for image_tag in self.image_tags])
+        for name in sorted(names.intersection(self._duplicate_names)):
+            uids = [att.uid for att in self._duplicate_names[name]]
+            self.report.add('image', "WARNING: the image name '" + name + "' is used by more " +
+                            "than one attachment (" + ", ".join(uids) + "), using " + 
+                            self._names[name].uid + ".", name, level=2)
 
     def _image_in_zotero(self, image_name):
         """Returns true if the image_name is in the list of attachments.
         """
-        print sum([[att.filename, att.title] for att in self.zot_attachments], [])
-        return image_name in sum([[att.filename, att.title] for att in self.zot_attachments], [])
+        return image_name in self._names
 
     def _get_attachment_from_zotero(self, image_name):
         """Gets the attachment object from zotero that matches this image name. Note that the name
         will first try tomatch the filename, and if that fails it will try to match the title. This
         means that in zotero you can use either the fileame or the title to refer to the image.
         """
-        att = [att for att in self.zot_attachments if att.filename == image_name]
-        if not att:
-            att = [att for att in self.zot_attachments if att.title == image_name]
-        if not att:
-            raise
-        return att
+        if image_name not in self._names:
+            raise Exception("The image '" + image_name + "' was not found in zotero.")
+        return self._names[image_name]
+
+    def _get_image_key(self, image_name):
+        """Returns the zotero key of the attachment for an image name, or the name if the image is
+        not in zotero. Used as the key in the profiler.
+        """
+        if self._image_in_zotero(image_name):
+            return self._get_attachment_from_zotero(image_name).uid
+        return image_name
 
     def _get_image_from_zotero(self, image_name):
         """Gets the image from zotero
         """
         att = self._get_attachment_from_zotero(image_name)
-        image_data = att[0].get_file_data(binary=True)
-        with open(os.path.join(self.images_dirpath, image_name), 'wb') as img_file:
-            img_file.write(image_data)
+        image_filepath = att.get_file()
+        new_filepath = os.path.join(self.images_dirpath, image_name)
+        temp_filepath = _get_temp_filepath(new_filepath)
+        shutil.copyfile(image_filepath, temp_filepath)
+        os.rename(temp_filepath, new_filepath)
 
     def _get_and_resize_image_from_zotero(self, original_name, new_name, width, height):
-        """Resize the image according to the width and height.
+        """Adds a job to resize the image according to the width and height. The jobs are all run 
+        at the end, see _resize_images().
         """
-        att = self._get_attachment_from_zotero(image_name)
-        image_filepath = att[0].get_file()
-        #TODO: reszie the image
+        att = self._get_attachment_from_zotero(original_name)
+        image_filepath = att.get_file()
+        self._add_resize_job(image_filepath, new_name, width, height, 
+                             self._get_image_inputs(original_name, width, height), 
+                             att.uid)
+
+    def _add_resize_job(self, image_filepath, new_name, width, height, inputs, key):
+        """Adds a job to resize an image. The inputs are saved in the manifest if the job succeeds.
+        The key is the key of the job in the profiler.
+        """
+        new_filepath = os.path.join(self.images_dirpath, new_name)
+        self._resize_jobs[new_filepath] = (image_filepath, new_filepath, width, height)
+        self._resize_inputs[new_filepath] = inputs
+        self._resize_keys[new_filepath] = key
+
+    def _resize_images(self):
+        """Runs all the resize jobs, using a pool of processes. The events for the jobs are added 
+        to the report.
+        """
+        jobs = sorted(self._resize_jobs.values())
+        self._resize_jobs = {}
+        keys = [self._resize_keys[job[1]] for job in jobs]
+        self._resize_keys = {}
+        if self.processes <= 1 or len(jobs) <= 1:
+            results = map_profiled(self.profiler, None, resize_image, 'resize', keys, jobs)
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+            try:
+                results = map_profiled(self.profiler, pool, resize_image, 'resize', keys, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        metrics = get_metrics()
+        for job, (success, event) in zip(jobs, results):
+            self.report.add_event(event)
+            metrics.inc('webtero_images_resized_total', status='ok' if success else 'error')
+            metrics.observe('webtero_image_resize_duration_seconds', event.duration)
+            if success:
+                self._update_manifest(job[1], self._resize_inputs[job[1]])
+        self._resize_inputs = {}
 
     def _image_in_dirpath(self, image_name):
         """Returns true if teh image_name is in the dirpath.
         """
         return os.path.isfile(os.path.join(self.images_dirpath, image_name))
 
+    def _get_image_inputs(self, image_name, *args):
+        """Returns the inputs that an image file is created from, for the manifest. If the image is
+        in zotero, this is the key of the attachment and the md5 (or version) of its file. If not,
+        and the image is in the dirpath, this is the size and modification time of that file. 
+        Otherwise, returns None. Any args (e.g. the width and height) are added to the inputs.
+        """
+        if self._image_in_zotero(image_name):
+            att = self._get_attachment_from_zotero(image_name)
+            tag = att.get_file_tag()
+            if tag is not None:
+                return ['zotero', att.uid, tag] + list(args)
+        if self._image_in_dirpath(image_name):
+            stat = os.stat(os.path.join(self.images_dirpath, image_name))
+            return ['file', stat.st_size, stat.st_mtime] + list(args)
+        return None
+
+    def _image_is_current(self, image_name, inputs):
+        """Returns true if the image file does not need to be created. If there is no manifest, 
+        this is the case when the file exists.
+        """
+        if self.manifest is None:
+            return self._image_in_dirpath(image_name)
+        if inputs is None:
+            return False
+        return self.manifest.is_current(os.path.join(self.images_dirpath, image_name), inputs)
+
+    def _update_manifest(self, image_filepath, inputs):
+        """Records the inputs of an image file that was created in the manifest.
+        """
+        if self.manifest is not None and inputs is not None:
+            self.manifest.update(image_filepath, inputs)
+
+    def _image_needs_update(self, image_tag):
+        """Returns true if the original or the resized image file for the image tag needs to be
+        created.
+        """
+        inputs = self._get_image_inputs(image_tag.original_name)
+        if not self._image_is_current(image_tag.original_name, inputs):
+            return True
+        if image_tag.new_name == image_tag.original_name:
+            return False
+        inputs = self._get_image_inputs(image_tag.original_name, image_tag.width, image_tag.height)
+        return not self._image_is_current(image_tag.new_name, inputs)
+
     def _create_original_image(self, image_tag):
         """Create the original image.
         """
-        if self._image_in_dirpath(image_tag.original_name):
-            return "Image was in dirpath."
         if not self._image_in_zotero(image_tag.original_name):
+            if self._image_in_dirpath(image_tag.original_name):
+                return "Image was in dirpath."
             return "Image was not found in zotero."
+        inputs = self._get_image_inputs(image_tag.original_name)
+        if self._image_is_current(image_tag.original_name, inputs):
+            return "Image was in dirpath."
         self._get_image_from_zotero(image_tag.original_name) 
+        self._update_manifest(os.path.join(self.images_dirpath, image_tag.original_name), inputs)
         return "Image was created."
 
     def _create_new_image(self, image_tag):
         """Create the new image.
         """
-        if self._image_in_dirpath(image_tag.new_name):
-            return "Image was in dirpath."
+        if image_tag.new_name == image_tag.original_name:
+            return "Image is the original image."
         if not self._image_in_zotero(image_tag.original_name):
+            if self._image_in_dirpath(image_tag.new_name):
+                return "Image was in dirpath."
             return "Image was not found in zotero."
+        inputs = self._get_image_inputs(image_tag.original_name, image_tag.width, image_tag.height)
+        if self._image_is_current(image_tag.new_name, inputs):
+            return "Image was in dirpath."
         self._get_and_resize_image_from_zotero(image_tag.original_name, image_tag.new_name, 
                                                 image_tag.width, image_tag.height) 
-        return "Image was created."
+        return "Image was added to the resize jobs."
+
+    def _create_variant_images(self, image_tag):
+        """Reads the size of the original image (only the header of the file is read), sets the 
+        variants of the image tag, and adds jobs to create the variant image files that do not 
+        exist. The variants are resized from the original image in the dirpath.
+        """
+        if not self._image_in_dirpath(image_tag.original_name):
+            return "Image variants were not created, the original image is missing."
+        original_filepath = os.path.join(self.images_dirpath, image_tag.original_name)
+        image_size = Image.open(original_filepath).size
+        image_tag.set_variants(image_size, self.image_widths, self.image_formats)
+        count = 0
+        for name, width, height, image_format in image_tag.variants:
+            inputs = self._get_image_inputs(image_tag.original_name, width, height, image_format)
+            if name == image_tag.new_name or self._image_is_current(name, inputs):
+                continue
+            self._add_resize_job(original_filepath, name, width, height, inputs, 
+                                 self._get_image_key(image_tag.original_name))
+            count += 1
+        return str(count) + " image variants were added to the resize jobs."
+
+    def _prefetch_images(self):
+        """Downloads all the images that are needed from zotero in parallel.
+        """
+        attachments = []
+        for image_tag in self.image_tags:
+            if not self._image_needs_update(image_tag):
+                continue
+            if self._image_in_zotero(image_tag.original_name):
+                attachments.append(self._get_attachment_from_zotero(image_tag.original_name))
+        prefetch_attachments(self.report, attachments, 2, self.profiler)
 
     def create_image_files(self):
         """Creates the images as follows. For each image tag, there are 2 images: the original 
-        and the resized.
+        and the resized. The images are first all downloaded in parallel. An event is added to 
+        the report for each image tag, and for each resized image.
         """
-        info_str = ""
+        self._add_duplicates_warnings()
+        try:
+            self._prefetch_images()
+        except Exception:
+            self.report.add_error('download', "Could not download the images.", level=2)
         for image_tag in self.image_tags:
+            start = time.time()
             try:
-                info_str += "  Image name: " + image_tag.original_name + "\n"
-                info_str += "  " + self._create_original_image(image_tag) + "\n"
-                info_str += "  Image name: " + image_tag.new_name + "\n"
-                info_str += "  " + self._create_new_image(image_tag) + "\n"
-            except:
-                #print "ERROR: could not create image file."
-                info_str += "  EXCEPTION: \n" + traceback.format_exc() + "\n"
-        return info_str
+                with profile(self.profiler, 'image', self._get_image_key(image_tag.original_name)):
+                    original_str = self._create_original_image(image_tag)
+                    new_str = self._create_new_image(image_tag)
+                    variants_str = self._create_variant_images(image_tag)
+                cache = 'hit' if original_str == "Image was in dirpath." else 'miss'
+                self.report.add('image', " ".join([original_str, new_str, variants_str]), 
+                                image_tag.original_name, time.time() - start, cache=cache, 
+                                level=2)
+            except Exception:
+                self.report.add_error('image', "Could not create the image files.", 
+                                      image_tag.original_name, 2)
+        self._resize_images()
+
+
+def _get_temp_filepath(filepath):
+    """Returns the path to a new temp file in the same folder and with the same extension as 
+    filepath, so that it can be renamed to filepath when it is complete.
+    """
+    dirpath, filename = os.path.split(filepath)
+    handle, temp_filepath = tempfile.mkstemp(
+        prefix='.' + filename + '.', suffix=os.path.splitext(filename)[1], dir=dirpath)
+    os.close(handle)
+    return temp_filepath
+
+
+def prefetch_attachments(report, attachments, level=1, profiler=None):
+    """Downloads the files of the attachments in parallel. An event is added to the report for 
+    each attachment, with the number of bytes that were downloaded (0 if the file was in the 
+    attachment store, or had already been got by an earlier build). If there is a profiler, the 
+    downloads are profiled as one section.
+    """
+    start = time.time()
+    missing = set(att.uid for att in attachments if att.filepath is None)
+    with profile(profiler, 'download'):
+        info_str = get_downloader().prefetch(attachments)
+    num_bytes = 0
+    for att in dict((att.uid, att) for att in attachments).values():
+        if att.filepath is None:
+            report.add('download', "Could not download '" + str(att.title) + "'.", att.uid, 
+                       error=info_str, level=level + 1)
+            continue
+        size = att.download_size if att.uid in missing else 0
+        cache = 'hit' if not size else 'miss'
+        report.add('download', "Got '" + str(att.title) + "'.", att.uid, num_bytes=size, 
+                   cache=cache, level=level + 1)
+        num_bytes += size
+    report.add('download', "Downloaded the files for " + str(len(attachments)) + " attachments.", 
+               duration=time.time() - start, num_bytes=num_bytes, level=level)
+
+
+def _observe_build(stage, duration):
+    """Records the duration of a stage of a build in the metrics.
+    """
+    metrics = get_metrics()
+    metrics.observe('webtero_build_duration_seconds', duration, stage=stage)
+    metrics.set('webtero_build_last_timestamp_seconds', time.time(), stage=stage)
+
+
+def resize_image(resize_job):
+    """Resizes an image. The resize_job is a tuple: (image_filepath, new_filepath, width, height).
+    If only the width or only the height is given, the other is calculated so that the aspect 
+    ratio stays the same. JPEG images are downscaled while they are decoded (using draft), which 
+    is much faster than decoding the full image. The new image is written to a temp file that is 
+    then renamed, so a partly written image is never left behind. This is a function so that it 
+    can be run by a pool of processes. Returns a tuple: (success, event), where the event is a 
+    BuildEvent.
+    """
+    image_filepath, new_filepath, width, height = resize_job
+    start = time.time()
+    name = os.path.basename(new_filepath)
+    success = False
+    try:
+        image = Image.open(image_filepath)
+        size = _get_resize_size(image.size, width, height)
+        if image.format == 'JPEG':
+            image.draft('RGB', size)
+        try:
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        except TypeError:
+            # Older versions of PIL do not have reducing_gap
+            image = image.resize(size, Image.LANCZOS)
+        temp_filepath = _get_temp_filepath(new_filepath)
+        try:
+            image.save(temp_filepath)
+            os.rename(temp_filepath, new_filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+        success = True
+    except Exception:
+        return success, BuildEvent('resize', "Could not resize the image.", name, 
+                                   time.time() - start, error=traceback.format_exc(), level=2)
+    return success, BuildEvent('resize', "Resized the image.", name, time.time() - start, 
+                               os.path.getsize(new_filepath), level=2)
+
+
+def _get_resize_size(original_size, width, height):
+    """Returns the (width, height) for a resized image. The width and height can be None (or 
+    strings, from the html attributes).
+    """
+    original_width, original_height = original_size
+    if width and height:
+        return int(width), int(height)
+    if width:
+        width = int(width)
+        return width, max(1, int(round(original_height * width / float(original_width))))
+    if height:
+        height = int(height)
+        return max(1, int(round(original_width * height / float(original_height)))), height
+    return original_width, original_height
 
 
 
@@ -284,7 +763,7 @@ class WebTab(object):
         self.html_attachments = None
         self.html_content = None
 
-    def initialize_data(self):
+    def initialize_data(self, report):
         """Add items based on data from zotero. Currently only three types of items are considered
         as being part of the web page: imagea are assumed to be attachments and artworks, and
         html is assumed to be an html attachment.
@@ -292,19 +771,22 @@ class WebTab(object):
         If there is only one html attachment, then the 
         content is assumed to be that one. if there is more than one, then selects the one 
         with the 'html-content' tag. If that does not exist, the choose the first attachment.
+
+        The events are added to the report, a BuildReport.
         """
-        info_str = "  Creating data for '" + self.name + "' tab.\n"
+        start = time.time()
+        uid = self.item.uid
         try:
             self.sort_key = int(self.item.callNumber)
             self.html_id = self.item.title.lower().replace(' ', '-')
         except Exception:
-            info_str += "  ERROR: Failed to set data for this web tabs.\n"
-            info_str += "  EXCEPTION: \n" + traceback.format_exc() + "\n"
+            report.add_error('tab', "Failed to set data for the '" + self.name + "' tab.", uid, 1)
         try:
             self.html_attachments = self.item.get_html_attachments()
             if self.html_attachments:
                 # Select the correct attachment
-                info_str += "  Html content was found: " + str(len(self.html_attachments)) + " files.\n"
+                report.add('tab', "Html content was found: " + str(len(self.html_attachments)) + 
+                           " files.", uid, level=2)
                 if len(self.html_attachments) == 1:
                     selected = self.html_attachments[0]
                 elif len(self.html_attachments) > 1:
@@ -316,13 +798,13 @@ class WebTab(object):
                         selected = self.html_attachments[0]
                 # Create the HtmlContent object
                 self.html_content = HtmlContent(self.html_id, selected)
-                info_str += self.html_content.initialize_data()
+                self.html_content.initialize_data(report)
             else:
-                info_str += "  No html content was found."
+                report.add('tab', "No html content was found.", uid, level=2)
         except Exception:
-            info_str += "  ERROR: Failed to get data from the zotero database.\n"
-            info_str += "  EXCEPTION: \n" + traceback.format_exc() + "\n"
-        return info_str
+            report.add_error('tab', "Failed to get data from the zotero database.", uid, 2)
+        report.add('tab', "Created data for the '" + self.name + "' tab.", uid, 
+                   time.time() - start, level=1)
 
     def get_button_html(self):
         """Return the tab button, an <a> inside an <li>.
@@ -339,18 +821,107 @@ class WebTab(object):
     def get_content_html(self, images_url):
         """Returns the html content of the tab, inside a <div> with an id attibute.
         """
-        # Create wrapper
-        soup = BeautifulSoup()
-        div_tag = soup.new_tag('div')
-        div_tag['id'] = self.html_id
-        div_tag.append(BeautifulSoup(self.html_content.get_html(images_url)))
-        soup.append(div_tag)
-        return str(soup)
+        return render_tab_content(self.get_render_args(images_url))
+
+    def get_render_inputs(self, images_url):
+        """Returns the inputs that the button and the content of this tab are rendered from, for 
+        the manifest: the tab name, the version of the html file, and the names and sizes of the 
+        images. Returns None if the version of the html file is not known.
+        """
+        html_attachment = self.html_content.html_attachment
+        tag = html_attachment.get_file_tag()
+        if tag is None:
+            return None
+        images = sorted([[image_key, image_tag.new_name, image_tag.display_size, image_tag.variants]
+                         for image_key, image_tag in self.html_content.image_tags.iteritems()])
+        return [self.name, self.html_id, html_attachment.uid, tag, images_url, images]
+
+    def get_render_args(self, images_url):
+        """Returns a tuple with the data needed to render the content of this tab, that can be 
+        pickled and sent to another process. See render_tab_content().
+        """
+        html_content = self.html_content
+        return (self.html_id, html_content.html_str, html_content.script_str, 
+                html_content.image_tags, images_url)
 
     def __str__(self):
         return self.name
 
 
+_PARSED_HTML = OrderedDict()
+_PARSED_HTML_LOCK = threading.Lock()
+# The max number of parsed html files that are kept in memory
+MAX_PARSED_HTML = 1000
+
+def _get_parsed_html(html_attachment):
+    """Returns the parsed data for this version of an html attachment, or None.
+    """
+    tag = html_attachment.get_file_tag()
+    if tag is None:
+        return None
+    with _PARSED_HTML_LOCK:
+        parsed = _PARSED_HTML.pop((html_attachment.uid, tag), None)
+        if parsed is not None:
+            _PARSED_HTML[(html_attachment.uid, tag)] = parsed
+    return parsed
+
+def _set_parsed_html(html_attachment, parsed):
+    """Saves the parsed data for this version of an html attachment. The least recently used data
+    is forgotten first.
+    """
+    tag = html_attachment.get_file_tag()
+    if tag is None:
+        return
+    with _PARSED_HTML_LOCK:
+        _PARSED_HTML[(html_attachment.uid, tag)] = parsed
+        while len(_PARSED_HTML) > MAX_PARSED_HTML:
+            _PARSED_HTML.popitem(last=False)
+
+
+def _get_html_attachments(item):
+    """Returns the html attachments of an item. Used by the thread pool in TabbedWebsite.
+    """
+    return item.get_html_attachments()
+
+
+def _initialize_tab(tab_args):
+    """Initialize the data for a tab. The tab_args is a tuple: (tab, report, profiler). Used by the
+    thread pool in TabbedWebsite.
+    """
+    tab, report, profiler = tab_args
+    with profile(profiler, 'tab', tab.item.uid):
+        tab.initialize_data(report)
+
+
+def _render_tab(render_args):
+    """Renders the content of a tab, see render_tab_content(). Returns a tuple: (content, duration).
+    Used by the pool of processes in TabbedWebsite.
+    """
+    start = time.time()
+    content = render_tab_content(render_args)
+    return content, time.time() - start
+
+
+def render_tab_content(render_args):
+    """Returns the html content of a tab, inside a <div> with an id attibute. The render_args are 
+    created by WebTab.get_render_args(). This is a function so that it can be run by a pool of 
+    processes.
+    """
+    html_id, html_str, script_str, image_tags, images_url = render_args
+    html_content = HtmlContent(html_id, None)
+    html_content.html_str = html_str
+    html_content.script_str = script_str
+    html_content.image_tags = image_tags
+    # Create wrapper, moving the content into it without parsing it again
+    soup = html_content.get_soup(images_url)
+    div_tag = soup.new_tag('div')
+    div_tag['id'] = html_id
+    for child in list(soup.contents):
+        div_tag.append(child.extract())
+    soup.append(div_tag)
+    return str(soup)
+
+
 class HtmlContent(object):
     """An html page created from a zotero collection. The standalone notes in the collection are
     assumed to be the html content of a page. The attachments in the collection are assumed to be
@@ -368,146 +939,155 @@ class HtmlContent(object):
         self.script_str = None
         self.image_tags = {}
 
-    def initialize_data(self):
-        """Get images and replace <img> and <pre> tags.
+    def initialize_data(self, report):
+        """Get images and replace <img> and <pre> tags. The parsed data is kept in memory, keyed by
+        the attachment key and file version, so the same version of a file is only parsed once.
+        The events are added to the report, a BuildReport.
         """
-        info_str = "    Creating data for html content.\n"
+        start = time.time()
+        uid = self.html_attachment.uid
         try:
-            html_str = self.html_attachment.get_file_data()
-            soup = BeautifulSoup(html_str)
-            # Get the script
-            script_tag = soup.find('script')
-            if script_tag:
-                self.script_str = script_tag.string
-            # Get the body and wrap it in a div
-            div_tag = soup.new_tag('div')
-            div_tag['class'] = 'html-content'
-            body_tag = soup.find('body')
-            div_tag.contents = body_tag.contents
-            self.html_str = str(div_tag)
+            parsed = _get_parsed_html(self.html_attachment)
+            cache = 'hit'
+            if parsed is None:
+                cache = 'miss'
+                parsed = self._parse_html()
+                _set_parsed_html(self.html_attachment, parsed)
+            self.html_str, self.script_str, image_specs = parsed
             # Create image tag objects
-            for img_tag in soup.find_all('img'):
-                image_tag = HtmlImageTag(str(img_tag))
-                info_str += image_tag.initialize_data()
-                self.image_tags[self._image_key(str(img_tag))] = image_tag
+            for image_key, src, width, height in image_specs:
+                image_tag = HtmlImageTag(src, width, height)
+                image_tag.initialize_data(report)
+                self.image_tags[image_key] = image_tag
+            report.add('html', "Created data for the html content.", uid, time.time() - start, 
+                       cache=cache, level=2)
         except Exception:
-            info_str += "    Failed to create html content.\n"
-            info_str += "    EXCEPTION: \n" + traceback.format_exc() + "\n"
+            report.add_error('html', "Failed to create html content.", uid, 2)
             self.html_str = "<p>No content found.</p>"
             self.toc_str = "<p>No content found.</p>"
-        return info_str
 
-    def _image_key(self, tag):
-        """Creates a uniques key for image image, used as the key for the dict.
+    def _parse_html(self):
+        """Parses the html file. Returns a tuple: (html_str, script_str, image_specs), where the 
+        image_specs are a list of (image_key, src, width, height).
         """
-        soup = BeautifulSoup(tag)
-        soup_img = soup.find('img')
-        src = soup_img.get('src')
-        width = soup_img.get('width')
-        height = soup_img.get('height')
+        html_str = self.html_attachment.get_file_data()
+        soup = BeautifulSoup(html_str)
+        # Get the script
+        script_str = None
+        script_tag = soup.find('script')
+        if script_tag:
+            script_str = script_tag.string
+        # Get the body and wrap it in a div
+        div_tag = soup.new_tag('div')
+        div_tag['class'] = 'html-content'
+        body_tag = soup.find('body')
+        div_tag.contents = body_tag.contents
+        # Get the image data
+        image_specs = [(self._image_key(img_tag), img_tag.get('src'), img_tag.get('width'), 
+                        img_tag.get('height')) for img_tag in soup.find_all('img')]
+        return str(div_tag), script_str, image_specs
+
+    def _image_key(self, img_tag):
+        """Creates a uniques key for image image, used as the key for the dict. The img_tag is a 
+        BeautifulSoup Tag.
+        """
+        src = img_tag.get('src')
+        width = img_tag.get('width')
+        height = img_tag.get('height')
         return str(src) + "_" + str(width) + "_" + str(height)
 
     def get_html(self, images_url):
         """Returns the html for the html content for this web page tab. 
         """
-        # Process the html str
-        self._process_jinja2()
-        self._process_img_tags(images_url)
-        self._process_h_tags()
-        self._process_toc()
-        return self.html_str
+        return str(self.get_soup(images_url))
+
+    def get_soup(self, images_url):
+        """Returns a BeautifulSoup object with the html content for this web page tab. The html is 
+        parsed once, and then the img tags, the h tags and the toc are all processed in one pass 
+        over the tree.
+        """
+        soup = BeautifulSoup(self._process_jinja2())
+        # Create the new tags for toc
+        div_tag = soup.new_tag('div')
+        div_tag['class'] = 'toc'
+        h2_tag = soup.new_tag('h2')
+        a_tag = soup.new_tag('a')
+        a_tag['href'] = '#top'
+        a_tag.string = 'Contents'
+        ul_tag = soup.new_tag('ul')
+        h2_tag.append(a_tag)
+        div_tag.append(h2_tag)
+        div_tag.append(ul_tag)
+        # Process the img and h tags
+        heading_index = 0
+        for tag in soup.find_all(['img', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
+            if tag.name == 'img':
+                self._process_img_tag(soup, tag, images_url)
+            else:
+                self._process_h_tag(soup, tag, heading_index, ul_tag)
+                heading_index += 1
+        # Add the toc to the start of the content
+        soup.insert(0, div_tag)
+        return soup
 
     def _process_jinja2(self):
-        """Process html assuming it is a jinja2 template.
+        """Process html assuming it is a jinja2 template, and returns the rendered html.
         The script can set the kwargs variable.
         """
-        # Create template
-        jinja_template = jinja2.Template(self.html_str.decode('utf-8'))
+        # Get the compiled template
+        jinja_template = get_string_template(self.html_str.decode('utf-8'))
         if self.script_str:
             exec(self.script_str)
         try:
             kwargs
         except NameError:
             kwargs = {}
-        self.html_str = jinja_template.render(**kwargs).encode('utf-8')
-
-    def _process_img_tags(self, images_url):
-        """Process img tags in the html: replace the src attribute.
-        """
-        # Create soup
-        soup = BeautifulSoup(self.html_str)
-        for old_img_soup in soup.find_all('img'):
-            # Find the right tag
-            image_tag = self.image_tags[self._image_key(str(old_img_soup))]
-            # Update the html
-            new_img = image_tag.get_html(images_url)
-            new_img_soup = BeautifulSoup(new_img).contents[0]
-            old_img_soup.replace_with(new_img_soup)
-        self.html_str = str(soup)
-
-    def _process_h_tags(self):
-        """Process h tags in the html: add a unique index to each h.
-        """
-        # Create soup
-        soup = BeautifulSoup(self.html_str)
-        for i, soup_h in enumerate(soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])):
-            soup_h['id'] = "h_" + str(self.html_id) + "_" + str(i)
-        self.html_str = str(soup)
-
-    def _process_toc(self):
-        """Creates a toc based on the headings, h1 to h6.
-        """
-        # Create soups
-        soup = BeautifulSoup(self.html_str)
-        toc_soup = BeautifulSoup()
-        # Create the new tags for toc
-        div_tag = toc_soup.new_tag('div')
-        div_tag['class'] = 'toc'
-        h2_tag = toc_soup.new_tag('h2')
-        a_tag = toc_soup.new_tag('a')
-        a_tag['href'] = '#top'
-        a_tag.string = 'Contents'
-        ul_tag = toc_soup.new_tag('ul')
-        h2_tag.append(a_tag)
-        toc_soup.append(div_tag)
-        div_tag.append(h2_tag)
-        div_tag.append(ul_tag)
-        # For each heading, add an li
-        for heading in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-            li_tag = toc_soup.new_tag('li')
-            li_tag['class'] = heading.name
-            a_tag = toc_soup.new_tag('a')
-            a_tag.string = heading.string
-            a_tag['href'] = '#' + heading['id']
-            li_tag.append(a_tag)
-            ul_tag.append(li_tag)
-        #Add the toc to the end of the content
-        toc_soup.append(soup)
-        self.html_str = str(toc_soup)
+        return jinja_template.render(**kwargs).encode('utf-8')
+
+    def _process_img_tag(self, soup, img_tag, images_url):
+        """Process an img tag in the html: replace it with the new tags for the image.
+        """
+        image_tag = self.image_tags[self._image_key(img_tag)]
+        img_tag.replace_with(image_tag.get_tag(soup, images_url))
+
+    def _process_h_tag(self, soup, h_tag, index, ul_tag):
+        """Process an h tag in the html: add a unique index to the h, and add an li to the toc.
+        """
+        h_tag['id'] = "h_" + str(self.html_id) + "_" + str(index)
+        li_tag = soup.new_tag('li')
+        li_tag['class'] = h_tag.name
+        a_tag = soup.new_tag('a')
+        a_tag.string = h_tag.get_text()
+        a_tag['href'] = '#' + h_tag['id']
+        li_tag.append(a_tag)
+        ul_tag.append(li_tag)
 
 class HtmlImageTag(object):
-    """An image in an html page. 
+    """An image in an html page. The args are the src, width and height attributes of the <img>.
     """
-    def __init__(self, tag):
+    def __init__(self, src, width=None, height=None):
         # The args
-        self.original_tag = tag
+        self.src = src
+        self.width_attr = width
+        self.height_attr = height
         # The data
         self.original_name = None
         self.height = None
         self.width = None
         self.new_name = None
+        # The data from the image file, see set_variants()
+        self.image_size = None
+        self.display_size = None
+        self.variants = []
 
-    def initialize_data(self):
+    def initialize_data(self, report=None):
         """Init the image data. First, check if the image exists in the images folder. If not, then 
-        create the image.
+        create the image. If there is a report, an event with the image names is added.
         """
-        info_str = "      Creating image tag.\n"
-        soup = BeautifulSoup(self.original_tag)
-        soup_img = soup.find('img')
-        self.original_name = soup_img.get('src')
+        self.original_name = self.src
         # Create the image urls
-        width = soup_img.get('width')
-        height = soup_img.get('height')
+        width = self.width_attr
+        height = self.height_attr
         self.new_name = self.original_name.split('.')[0]
         if width:
             self.width = width
@@ -516,26 +1096,86 @@ class HtmlImageTag(object):
             self.height = height
             self.new_name += '_h' + str(height)
         self.new_name += '.' + self.original_name.split('.')[1]
-        info_str += "      Image names:" + self.original_name + ", " + self.new_name + "\n"
-        return info_str
+        if report is not None:
+            report.add('html', "Image names: " + self.original_name + ", " + self.new_name, 
+                       self.src, level=3)
+
+    def set_variants(self, image_size, widths, formats):
+        """Sets the size of the original image, and creates the list of variants of this image. 
+        There is a variant for each of the widths that is smaller than the original image and 
+        smaller than twice the displayed width, plus the displayed width itself. Each width is 
+        created in the original format and in each of the formats. The variants are tuples: 
+        (name, width, height, format).
+        """
+        self.image_size = image_size
+        self.display_size = _get_resize_size(image_size, self.width, self.height)
+        display_width, display_height = self.display_size
+        original_base = self.original_name.split('.')[0]
+        new_base, original_format = self.new_name.rsplit('.', 1)
+        self.variants = []
+        for image_format in (original_format,) + tuple(formats):
+            self.variants.append((new_base + '.' + image_format, display_width, display_height, 
+                                  image_format))
+            for width in widths:
+                if width == display_width or width >= image_size[0] or width >= display_width * 2:
+                    continue
+                height = _get_resize_size(image_size, width, None)[1]
+                name = original_base + '_w' + str(width) + '.' + image_format
+                self.variants.append((name, width, height, image_format))
 
     def get_html(self, images_url):
         """Get the html for this image tag. When you click on the image, it links to a big version
         of the image.
         """
+        return str(self.get_tag(BeautifulSoup(), images_url))
+
+    def get_tag(self, soup, images_url):
+        """Get the new tags for this image, created with the soup, an <img> inside an <a>. If the 
+        variants have been set, the <img> has a srcset and the size of the image, and if there are
+        variants in other formats, the <img> is inside a <picture> with a <source> for each format.
+        """
         img_original_url = images_url + self.original_name
         img_resized_url = images_url + self.new_name 
         # Create the new image tag
-        a_img_soup = BeautifulSoup()
-        a_tag = a_img_soup.new_tag('a')
+        a_tag = soup.new_tag('a')
         a_tag['href'] = img_original_url
-        img_tag = a_img_soup.new_tag('img')
+        img_tag = soup.new_tag('img')
         img_tag['src'] = img_resized_url
-        a_img_soup.append(a_tag)
-        a_tag.append(img_tag)
-        new_tag = str(a_img_soup)
-        # Return
-        return new_tag
+        img_tag['loading'] = 'lazy'
+        if not self.variants:
+            a_tag.append(img_tag)
+            return a_tag
+        display_width, display_height = self.display_size
+        sizes = "(max-width: " + str(display_width) + "px) 100vw, " + str(display_width) + "px"
+        img_tag['width'] = str(display_width)
+        img_tag['height'] = str(display_height)
+        # Create the srcset for each format
+        original_format = self.new_name.rsplit('.', 1)[1]
+        image_formats = []
+        for variant in self.variants:
+            if variant[3] not in image_formats:
+                image_formats.append(variant[3])
+        picture_tag = soup.new_tag('picture')
+        for image_format in image_formats:
+            variants = sorted([(width, name) for name, width, _, variant_format in self.variants 
+                               if variant_format == image_format])
+            srcset = ", ".join([images_url + name + " " + str(width) + "w" 
+                                for width, name in variants])
+            if image_format == original_format:
+                img_tag['srcset'] = srcset
+                img_tag['sizes'] = sizes
+            else:
+                source_tag = soup.new_tag('source')
+                source_tag['type'] = 'image/' + image_format
+                source_tag['srcset'] = srcset
+                source_tag['sizes'] = sizes
+                picture_tag.append(source_tag)
+        if picture_tag.contents:
+            picture_tag.append(img_tag)
+            a_tag.append(picture_tag)
+        else:
+            a_tag.append(img_tag)
+        return a_tag
 
 # ================================================================================================
 # Testing
@@ -554,14 +1194,16 @@ def test_tabs():
     FILES_COLL = "Patrick Janssen Websites/_Files"
     IMGS_COLL = "Patrick Janssen Websites/_Images"
 
-    twp = TabbedWebsite(WEBSITE_COLL, FILES_COLL, IMGS_COLL) 
-    print twp.initialize_data()
+    report = BuildReport([LogSink(), SummarySink()])
+    twp = TabbedWebsite(WEBSITE_COLL, FILES_COLL, IMGS_COLL, report=report) 
+    twp.initialize_data()
 
     WEBSITE_FILEPATH = CURR_DIR + "/test/index.html"
     IMAGES_DIRPATH = CURR_DIR + "/test/img/"
     IMAGES_URL = "./img/"
 
-    print twp.create_website(WEBSITE_FILEPATH, IMAGES_URL, IMAGES_DIRPATH)
+    twp.create_website(WEBSITE_FILEPATH, IMAGES_URL, IMAGES_DIRPATH)
+    report.close()
     print "Finished..."
 
 
@@ -0,0 +1,116 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A shared jinja2 environment, so that each template is only compiled once.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jinja2
+
+# ================================================================================================
+# Loader
+# ================================================================================================
+
+class ZoteroTemplateLoader(jinja2.BaseLoader):
+    """A jinja2 loader for templates that are stored in zotero attachments, or that are created 
+    from strings. Each template name includes the attachment key and version (or the hash of the 
+    string), so a template never changes once it has been loaded, and the compiled template can be
+    reused until it is evicted from the environment cache. At most max_sources template sources 
+    are remembered, the least recently used are forgotten first.
+    """
+    def __init__(self, max_sources=400):
+        self.max_sources = max_sources
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, get_source):
+        """Adds a template. The get_source function is called with no args to get the source as a
+        unicode string, but only if the compiled template is not in the environment cache.
+        """
+        with self._lock:
+            self._sources.pop(name, None)
+            self._sources[name] = get_source
+            while len(self._sources) > self.max_sources:
+                self._sources.popitem(last=False)
+
+    def get_source(self, environment, template):
+        """Returns the source of a template, as required by jinja2.
+        """
+        with self._lock:
+            get_source = self._sources.get(template)
+        if get_source is None:
+            raise jinja2.TemplateNotFound(template)
+        return get_source(), None, lambda: True
+
+# ================================================================================================
+# The shared environment
+# ================================================================================================
+
+_ENVIRONMENT = []
+
+def create_environment(cache_size=400, bytecode_dirpath=None):
+    """Creates a jinja2 environment with a ZoteroTemplateLoader. The environment keeps up to 
+    cache_size compiled templates in memory. If bytecode_dirpath is given, the compiled templates 
+    are also saved in that folder, so they do not need to be compiled again in the next run.
+    """
+    bytecode_cache = None
+    if bytecode_dirpath:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dirpath)
+    return jinja2.Environment(loader=ZoteroTemplateLoader(cache_size), cache_size=cache_size, 
+                              bytecode_cache=bytecode_cache)
+
+def get_environment():
+    """Returns the shared jinja2 environment. It is created the first time it is needed.
+    """
+    if not _ENVIRONMENT:
+        _ENVIRONMENT.append(create_environment())
+    return _ENVIRONMENT[0]
+
+def set_environment(environment):
+    """Sets the shared jinja2 environment. The loader must be a ZoteroTemplateLoader.
+    """
+    del _ENVIRONMENT[:]
+    _ENVIRONMENT.append(environment)
+
+def get_attachment_template(attachment):
+    """Returns the compiled jinja2 template for a ZoteroAttachment. The file is only read, and the 
+    template only compiled, if this version of the attachment is not in the cache. If the version 
+    of the attachment is not known, the template is cached by the content of the file.
+    """
+    tag = attachment.get_file_tag()
+    if tag is None:
+        return get_string_template(attachment.get_file_data().decode('utf-8'))
+    name = 'attachment/' + attachment.uid + '/' + tag
+    environment = get_environment()
+    environment.loader.add(name, lambda: attachment.get_file_data().decode('utf-8'))
+    return environment.get_template(name)
+
+def get_string_template(source):
+    """Returns the compiled jinja2 template for a unicode string. The template is only compiled if 
+    the same string is not in the cache.
+    """
+    name = 'string/' + hashlib.sha1(source.encode('utf-8')).hexdigest()
+    environment = get_environment()
+    environment.loader.add(name, lambda: source)
+    return environment.get_template(name)
@@ -0,0 +1,217 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A local cache for the responses from the zotero api. 
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import json
+
+# ================================================================================================
+# Cache
+# ================================================================================================
+
+DEFAULT_CACHE_FILEPATH = os.path.join(os.path.expanduser('~'), '.webtero', 'zotero_cache.sqlite')
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+class ZoteroCache(object):
+    """A cache for api responses, saved in an sqlite file. Each entry is keyed by the group id, the
+    library version of the group, and a request key (e.g. 'collection_items/ABCD1234'). When the 
+    library version changes, the old entries are no longer used and are replaced when the new 
+    response is saved. The total size of the cache is limited to max_bytes, and the least recently 
+    used entries are evicted first.
+    """
+    def __init__(self, filepath=DEFAULT_CACHE_FILEPATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.renewals = 0
+        self._lock = threading.Lock()
+        dirpath = os.path.dirname(filepath)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "group_uid TEXT, request_key TEXT, version INTEGER, data TEXT, size INTEGER, "
+            "last_access REAL, PRIMARY KEY (group_uid, request_key))")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_versions (group_uid TEXT PRIMARY KEY, version INTEGER)")
+        self._conn.commit()
+
+    def get(self, group_uid, version, request_key):
+        """Returns the cached response, or None if there is no response for this library version.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM responses WHERE group_uid=? AND request_key=? AND version=?",
+                (str(group_uid), request_key, version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE responses SET last_access=? WHERE group_uid=? AND request_key=?",
+                (time.time(), str(group_uid), request_key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, group_uid, version, request_key, data):
+        """Saves a response. Any response for an older library version is replaced.
+        """
+        data_str = json.dumps(data)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (str(group_uid), request_key, version, data_str, len(data_str), time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def get_entry(self, group_uid, version, request_key):
+        """Returns a tuple: (cached_version, data), the cached response and its library version, 
+        which may be older than this version, or (None, None) if there is no response. Only a 
+        response for this version is counted as a hit.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, data FROM responses WHERE group_uid=? AND request_key=?",
+                (str(group_uid), request_key)).fetchone()
+            if row is None or row[0] != version:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._conn.execute(
+                    "UPDATE responses SET last_access=? WHERE group_uid=? AND request_key=?",
+                    (time.time(), str(group_uid), request_key))
+                self._conn.commit()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def renew(self, group_uid, request_key, old_version, new_version):
+        """Moves a response from the old library version to the new library version, when zotero 
+        says that the response has not changed. 
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE responses SET version=?, last_access=? "
+                "WHERE group_uid=? AND request_key=? AND version=?",
+                (new_version, time.time(), str(group_uid), request_key, old_version))
+            self._conn.commit()
+            self.renewals += 1
+
+    def carry_forward(self, group_uid, old_version, new_version, patch):
+        """Moves the entries for the old library version to the new library version. The patch 
+        function is called as patch(request_key, data) and returns the updated data, or None if the 
+        entry cannot be updated (in which case it is left behind). All the entries are saved in 
+        one transaction, and the cache is only evicted once at the end.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT request_key, data FROM responses WHERE group_uid=? AND version=?",
+                (str(group_uid), old_version)).fetchall()
+        new_rows = []
+        now = time.time()
+        for request_key, data_str in rows:
+            data = patch(request_key, json.loads(data_str))
+            if data is not None:
+                data_str = json.dumps(data)
+                new_rows.append((str(group_uid), request_key, new_version, data_str, 
+                                 len(data_str), now))
+        if not new_rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", new_rows)
+            self._evict()
+            self._conn.commit()
+
+    def get_sync_version(self, group_uid):
+        """Returns the last library version that was seen for a group, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM sync_versions WHERE group_uid=?", (str(group_uid),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_sync_version(self, group_uid, version):
+        """Saves the last library version that was seen for a group.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_versions VALUES (?, ?)", (str(group_uid), version))
+            self._conn.commit()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache is smaller than max_bytes.
+        """
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT group_uid, request_key, size FROM responses ORDER BY last_access").fetchall()
+        for group_uid, request_key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute(
+                "DELETE FROM responses WHERE group_uid=? AND request_key=?", (group_uid, request_key))
+            total -= size
+            self.evictions += 1
+
+    def invalidate(self, group_uid=None):
+        """Deletes all the entries for a group. If no group is given, the whole cache is cleared.
+        """
+        with self._lock:
+            if group_uid is None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.execute("DELETE FROM sync_versions")
+            else:
+                self._conn.execute("DELETE FROM responses WHERE group_uid=?", (str(group_uid),))
+                self._conn.execute("DELETE FROM sync_versions WHERE group_uid=?", (str(group_uid),))
+            self._conn.commit()
+
+    def get_stats(self):
+        """Returns a dict with the hits, misses, evictions, renewals, number of entries and size in 
+        bytes.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 
+                'renewals': self.renewals, 'entries': entries, 'bytes': size}
+
+    def __str__(self):
+        """An str representation, with the stats.
+        """
+        stats = self.get_stats()
+        return ("Cache " + self.filepath + ": " + str(stats['hits']) + " hits, " + 
+                str(stats['misses']) + " misses, " + str(stats['evictions']) + " evictions, " + 
+                str(stats['renewals']) + " renewals, " + 
+                str(stats['entries']) + " entries, " + str(stats['bytes']) + " bytes.")
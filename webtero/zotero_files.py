@@ -0,0 +1,364 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""Downloads the files attached to zotero items.
+"""
+
+import os
+import hashlib
+import urlparse
+import tempfile
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from zotero_scheduler import get_scheduler
+from build_metrics import get_metrics
+
+# ================================================================================================
+# Downloader
+# ================================================================================================
+
+API_URL = "https://api.zotero.org"
+
+class ZoteroSession(requests.Session):
+    """An http session that does not send the zotero api key to other hosts. Zotero redirects the 
+    file downloads to the file storage, and requests only removes the 'Authorization' header when 
+    a redirect goes to another host.
+    """
+    def rebuild_auth(self, prepared_request, response):
+        """Removes the 'Zotero-API-Key' header when redirected to another host.
+        """
+        requests.Session.rebuild_auth(self, prepared_request, response)
+        old_host = urlparse.urlparse(response.request.url).hostname
+        if urlparse.urlparse(prepared_request.url).hostname != old_host:
+            prepared_request.headers.pop('Zotero-API-Key', None)
+
+
+class AttachmentDownloader(object):
+    """Downloads attachment files from zotero. All the downloads share one http session, so the 
+    connections are kept alive and reused. The requests go through the RequestScheduler, which 
+    limits the rate and retries failed downloads, waiting longer after each failure. Many files 
+    can be downloaded in parallel with prefetch().
+    """
+    def __init__(self, workers=8, timeout=60):
+        self.workers = workers
+        self.timeout = timeout
+        self.session = ZoteroSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_group_url(self, group_uid, path):
+        """Returns the api url for a path in a group, e.g. '/collections'.
+        """
+        return get_api_url() + "/groups/" + str(group_uid) + path
+
+    def get_file_url(self, group_uid, item_uid):
+        """Returns the url for downloading the file of an attachment.
+        """
+        return self.get_group_url(group_uid, "/items/" + item_uid + "/file")
+
+    def download(self, url, zot_key, filepath):
+        """Downloads a file and saves it to filepath. Returns the number of bytes.
+        """
+        response = self._get(url, zot_key, endpoint='file')
+        size = 0
+        with open(filepath, 'wb') as local_file:
+            for chunk in response.iter_content(64 * 1024):
+                local_file.write(chunk)
+                size += len(chunk)
+        get_metrics().inc('webtero_download_bytes_total', size)
+        return size
+
+    def get_versions(self, url, zot_key):
+        """Returns the versions of all the objects for an api url, as a dict keyed by the object 
+        key. Only the keys and the versions are downloaded (format=versions), in one request.
+        """
+        response = self._get(url, zot_key, params={'format': 'versions'}, endpoint='versions')
+        try:
+            return response.json()
+        finally:
+            response.close()
+
+    def _get(self, url, zot_key, headers=None, params=None, endpoint='other'):
+        """Makes the request through the scheduler. The endpoint is the name of the request in the
+        metrics.
+        """
+        headers = dict(headers or {})
+        headers['Zotero-API-Key'] = zot_key
+        return get_scheduler().call(self._get_once, (url, headers, params), endpoint=endpoint)
+
+    def _get_once(self, url, headers, params=None):
+        """Makes the request once. Raises an exception for error status codes.
+        """
+        response = self.session.get(url, headers=headers, params=params, stream=True, 
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def prefetch(self, attachments):
+        """Downloads the files for a list of ZoteroAttachment objects in parallel. Attachments that 
+        have already been downloaded are skipped. Returns an info str.
+        """
+        info_str = "Downloading attachment files.\n"
+        unique = {}
+        for att in attachments:
+            if att.filepath is None:
+                unique[att.uid] = att
+        if not unique:
+            return info_str
+        pool = ThreadPool(min(self.workers, len(unique)))
+        try:
+            results = pool.map(_prefetch_attachment, unique.values())
+        finally:
+            pool.close()
+        for att, error in zip(unique.values(), results):
+            if error:
+                info_str += "ERROR: could not download '" + str(att.title) + "'.\n"
+                info_str += "EXCEPTION: \n" + error + "\n"
+        info_str += "Downloaded " + str(len(unique)) + " files.\n"
+        return info_str
+
+
+def _prefetch_attachment(att):
+    """Downloads one attachment. Returns None, or the traceback if it failed.
+    """
+    try:
+        att.get_file()
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+# ================================================================================================
+# Store
+# ================================================================================================
+
+DEFAULT_STORE_DIRPATH = os.path.join(os.path.expanduser('~'), '.webtero', 'attachments')
+DEFAULT_STORE_MAX_BYTES = 1024 * 1024 * 1024
+# When the store is full, files are deleted until it is this fraction of max_bytes
+STORE_EVICT_RATIO = 0.9
+
+class AttachmentStore(object):
+    """A folder where the downloaded attachment files are kept between runs. Each file is named 
+    after the item key and a tag for the version of the file (the md5 that zotero reports for the 
+    file, or else the item version). When a new version of a file is added, the old versions are 
+    deleted. The total size of the files is limited to max_bytes, and the least recently used 
+    files are deleted first.
+
+    The folder is listed once, the first time a file is added, and after that the files and the 
+    total size are kept up to date as files are added and deleted.
+    """
+    def __init__(self, dirpath=DEFAULT_STORE_DIRPATH, max_bytes=DEFAULT_STORE_MAX_BYTES):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._verified = set()
+        self._sizes = None
+        self._item_filepaths = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+    def _get_filepath(self, item_uid, tag):
+        """Returns the path of the file for this item key and tag.
+        """
+        return os.path.join(self.dirpath, item_uid + '_' + str(tag))
+
+    def get(self, item_uid, tag, md5=None):
+        """Returns the path of the stored file, or None if it is not in the store. If the md5 is 
+        given, the file is checked the first time it is used in this process, and if it does not 
+        match it is deleted.
+        """
+        filepath = self._get_filepath(item_uid, tag)
+        if tag is None or not os.path.isfile(filepath):
+            self.misses += 1
+            return None
+        if md5 and filepath not in self._verified:
+            if get_md5(filepath) != md5:
+                with self._lock:
+                    self._remove_file(item_uid, filepath)
+                self.misses += 1
+                return None
+            self._verified.add(filepath)
+        os.utime(filepath, None)
+        self.hits += 1
+        return filepath
+
+    def get_temp_filepath(self, tag):
+        """Returns the path to a new temp file for downloading a file to. The temp file is in the 
+        store folder, except if the tag is None: such files cannot be found again, so they are not
+        put in the store.
+        """
+        if tag is None:
+            handle, filepath = tempfile.mkstemp(prefix='webtero_')
+        else:
+            handle, filepath = tempfile.mkstemp(prefix='.download_', dir=self.dirpath)
+        os.close(handle)
+        return filepath
+
+    def put(self, item_uid, tag, temp_filepath, md5=None):
+        """Moves a downloaded temp file into the store, and returns the new path. If the md5 is 
+        given and does not match, the temp file is deleted and an exception is raised. Any other 
+        versions of the file are deleted. If the tag is None, the temp file is not moved and its 
+        path is returned.
+        """
+        if md5 and get_md5(temp_filepath) != md5:
+            os.remove(temp_filepath)
+            raise Exception("The md5 of the file downloaded for '" + item_uid + "' is wrong.")
+        if tag is None:
+            return temp_filepath
+        filepath = self._get_filepath(item_uid, tag)
+        with self._lock:
+            self._list_files()
+            for old_filepath in list(self._item_filepaths.get(item_uid, [])):
+                self._remove_file(item_uid, old_filepath)
+            os.rename(temp_filepath, filepath)
+            self._add_file(item_uid, filepath)
+            if md5:
+                self._verified.add(filepath)
+            if self._total_bytes > self.max_bytes:
+                self._evict(filepath)
+        return filepath
+
+    def _list_files(self):
+        """Lists the files in the store folder and their sizes, the first time it is called. Must 
+        be called with the lock.
+        """
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        self._item_filepaths = {}
+        self._total_bytes = 0
+        for filename in os.listdir(self.dirpath):
+            if not filename.startswith('.'):
+                self._add_file(filename.partition('_')[0], os.path.join(self.dirpath, filename))
+
+    def _add_file(self, item_uid, filepath):
+        """Adds a file to the list of files in the store. Must be called with the lock.
+        """
+        size = os.path.getsize(filepath)
+        self._sizes[filepath] = size
+        self._item_filepaths.setdefault(item_uid, []).append(filepath)
+        self._total_bytes += size
+
+    def _remove_file(self, item_uid, filepath):
+        """Deletes a file from the store. Must be called with the lock.
+        """
+        try:
+            os.remove(filepath)
+        except OSError:
+            # Already deleted, e.g. by another process using the same store
+            pass
+        self._verified.discard(filepath)
+        if self._sizes is None:
+            return
+        self._total_bytes -= self._sizes.pop(filepath, 0)
+        filepaths = self._item_filepaths.get(item_uid, [])
+        if filepath in filepaths:
+            filepaths.remove(filepath)
+            if not filepaths:
+                del self._item_filepaths[item_uid]
+
+    def _evict(self, keep_filepath):
+        """Deletes the least recently used files until the store is smaller than max_bytes times
+        STORE_EVICT_RATIO, so that the files are not checked again for the next few files that are 
+        added. Must be called with the lock.
+        """
+        files = []
+        for item_uid, filepaths in self._item_filepaths.iteritems():
+            for filepath in filepaths:
+                try:
+                    files.append((os.path.getmtime(filepath), item_uid, filepath))
+                except OSError:
+                    files.append((0, item_uid, filepath))
+        files.sort()
+        max_bytes = self.max_bytes * STORE_EVICT_RATIO
+        for _, item_uid, filepath in files:
+            if self._total_bytes <= max_bytes:
+                break
+            if filepath != keep_filepath:
+                self._remove_file(item_uid, filepath)
+
+
+def get_md5(filepath):
+    """Returns the md5 hex digest of a file.
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(64 * 1024), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# ================================================================================================
+# The api url, downloader and store used by the zotero reader
+# ================================================================================================
+
+_API_URL = []
+_DOWNLOADER = []
+_STORE = []
+
+def get_api_url():
+    """Returns the base url of the zotero api, API_URL unless it was changed with set_api_url().
+    """
+    if not _API_URL:
+        return API_URL
+    return _API_URL[0]
+
+def set_api_url(api_url):
+    """Sets the base url of the zotero api used by the reader and the downloader, e.g. the url of a
+    local MockZoteroServer. Set to None to use API_URL.
+    """
+    del _API_URL[:]
+    if api_url is not None:
+        _API_URL.append(api_url.rstrip('/'))
+
+def get_downloader():
+    """Returns the AttachmentDownloader used by ZoteroAttachment objects. It is created the first 
+    time it is needed.
+    """
+    if not _DOWNLOADER:
+        _DOWNLOADER.append(AttachmentDownloader())
+    return _DOWNLOADER[0]
+
+def set_downloader(downloader):
+    """Sets the AttachmentDownloader used by ZoteroAttachment objects.
+    """
+    del _DOWNLOADER[:]
+    _DOWNLOADER.append(downloader)
+
+def get_store():
+    """Returns the AttachmentStore used by ZoteroAttachment objects. It is created the first time 
+    it is needed.
+    """
+    if not _STORE:
+        _STORE.append(AttachmentStore())
+    return _STORE[0]
+
+def set_store(store):
+    """Sets the AttachmentStore used by ZoteroAttachment objects.
+    """
+    del _STORE[:]
+    _STORE.append(store)
@@ -0,0 +1,450 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""A local stand-in for the zotero web api, for testing and measuring the reader without a network.
+"""
+
+import sys
+import json
+import time
+import random
+import socket
+import hashlib
+import urlparse
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# The chars used in zotero keys
+KEY_CHARS = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+# The default and the max number of results per page, as in the zotero api
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+# ================================================================================================
+# Library
+# ================================================================================================
+
+class MockLibrary(object):
+    """A synthetic zotero group library. Collections, items, attachments and files are added with 
+    the add methods. Each change increases the library version, and each object records the 
+    version in which it was last changed, as in zotero. The keys are created from a seeded random
+    generator, so the same calls always create the same library.
+
+    The objects are saved in the same form as the 'data' of the objects in the zotero api (v3), 
+    e.g. collections have 'key', 'name' and 'parentCollection'. The server sends each object in 
+    an envelope, see MockZoteroHandler._get_envelope().
+    """
+    def __init__(self, group_id, name, seed=0):
+        self.group_id = group_id
+        self.name = name
+        self.version = 0
+        self.collections = {}
+        self.items = {}
+        self.files = {}
+        self.deleted = {u'collections': {}, u'items': {}}
+        self._random = random.Random(seed)
+        self._results = {}
+        self._results_version = None
+        self._num_children = {}
+        self._num_children_version = None
+        self._lock = threading.Lock()
+
+    def _new_key(self):
+        """Returns a new unique key.
+        """
+        while True:
+            key = u"".join(self._random.choice(KEY_CHARS) for _ in range(8))
+            if key not in self.collections and key not in self.items:
+                return key
+
+    def _new_version(self):
+        """Increases the library version, and returns it.
+        """
+        self.version += 1
+        return self.version
+
+    def add_collection(self, name, parent=None):
+        """Adds a collection, parent is the key of the parent collection. Returns the key.
+        """
+        with self._lock:
+            key = self._new_key()
+            self.collections[key] = {u'key': key, u'name': unicode(name), 
+                                     u'parentCollection': parent or False, u'relations': {}, 
+                                     u'version': self._new_version()}
+        return key
+
+    def add_item(self, title, collections=(), item_type=u'document', tags=(), **fields):
+        """Adds an item to a list of collections. Returns the key.
+        """
+        with self._lock:
+            key = self._new_key()
+            data = {u'key': key, u'itemType': item_type, u'title': unicode(title), 
+                    u'collections': list(collections), u'tags': [{u'tag': tag} for tag in tags],
+                    u'version': self._new_version()}
+            data.update(fields)
+            self.items[key] = data
+        return key
+
+    def add_attachment(self, parent, filename, file_data, content_type, tags=()):
+        """Adds an attachment with a file to an item. Returns the key.
+        """
+        with self._lock:
+            key = self._new_key()
+            self.items[key] = {u'key': key, u'itemType': u'attachment', u'title': unicode(filename),
+                               u'filename': unicode(filename), u'contentType': content_type, 
+                               u'linkMode': u'imported_file', u'parentItem': parent, 
+                               u'md5': hashlib.md5(file_data).hexdigest(), 
+                               u'tags': [{u'tag': tag} for tag in tags], 
+                               u'version': self._new_version()}
+            self.files[key] = file_data
+        return key
+
+    def update_item(self, key, **fields):
+        """Changes the fields of an item. If the file data is given, the file is replaced.
+        """
+        with self._lock:
+            file_data = fields.pop('file_data', None)
+            if file_data is not None:
+                self.files[key] = file_data
+                fields[u'md5'] = hashlib.md5(file_data).hexdigest()
+            self.items[key].update(fields)
+            self.items[key][u'version'] = self._new_version()
+
+    def delete_item(self, key):
+        """Deletes an item.
+        """
+        with self._lock:
+            del self.items[key]
+            self.files.pop(key, None)
+            self.deleted[u'items'][key] = self._new_version()
+
+    def delete_collection(self, key):
+        """Deletes a collection.
+        """
+        with self._lock:
+            del self.collections[key]
+            self.deleted[u'collections'][key] = self._new_version()
+
+    def get_num_children(self, key):
+        """Returns the number of child items of an item. The counts are kept until the library 
+        changes. Must be called with the lock.
+        """
+        if self._num_children_version != self.version:
+            self._num_children = {}
+            for data in self.items.itervalues():
+                parent = data.get(u'parentItem')
+                if parent:
+                    self._num_children[parent] = self._num_children.get(parent, 0) + 1
+            self._num_children_version = self.version
+        return self._num_children.get(key, 0)
+
+# ================================================================================================
+# Server
+# ================================================================================================
+
+class MockZoteroServer(ThreadingMixIn, HTTPServer):
+    """A local http server that answers zotero api requests for a list of MockLibrary objects. It 
+    supports the requests made by the reader: groups, collections, collection items, children, 
+    items, versions, deleted objects, and file downloads, with paging (start and limit), the 
+    'Last-Modified-Version', 'Total-Results' and 'Link' headers, and '304 Not Modified' replies 
+    to the 'If-Modified-Since-Version' header. As in zotero, the objects are sent in envelopes, 
+    and for requests of multiple objects the 'If-Modified-Since-Version' header is compared with 
+    the library version.
+
+    To measure and test the reader, each request can be delayed by latency seconds, and every 
+    throttle_every request can be refused with '429 Too Many Requests' and a 'Retry-After' header.
+
+    Use start() to serve in a background thread, and point the reader at the server with 
+    zotero_files.set_api_url(server.get_url()).
+    """
+    daemon_threads = True
+    # Many connections are opened at once by the downloader
+    request_queue_size = 64
+
+    def __init__(self, libraries, port=0, latency=0.0, throttle_every=0, retry_after=1):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockZoteroHandler)
+        self.libraries = dict((str(library.group_id), library) for library in libraries)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self._thread = None
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def get_url(self):
+        """Returns the base url of the server, to use instead of https://api.zotero.org.
+        """
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def start(self):
+        """Serves requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the server. Open connections (kept alive by clients) are closed.
+        """
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # Wait for the threads to finish with the connections
+        for _ in range(100):
+            with self._lock:
+                if not self._connections:
+                    break
+            time.sleep(0.01)
+
+    def process_request_thread(self, request, client_address):
+        """Handles a connection in a thread, and keeps track of the open connections.
+        """
+        with self._lock:
+            self._connections.add(request)
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._lock:
+                self._connections.discard(request)
+
+    def count_request(self):
+        """Counts a request. Returns True if the request should be throttled.
+        """
+        with self._lock:
+            self.requests += 1
+            throttle = self.throttle_every > 0 and self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        return throttle
+
+
+class MockZoteroHandler(BaseHTTPRequestHandler):
+    """Answers one request for the MockZoteroServer.
+    """
+    protocol_version = 'HTTP/1.1'
+    # The reply is written in one go, else small replies are delayed on kept alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """Answers a GET request.
+        """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.count_request():
+            self._send(429, "Too Many Requests", 'text/plain', 
+                       {'Retry-After': str(self.server.retry_after)})
+            return
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+        if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'groups':
+            groups = [{u'id': library.group_id, u'version': library.version, u'meta': {}, 
+                       u'data': {u'id': library.group_id, u'version': library.version, 
+                                 u'name': library.name, u'type': u'Private'}} 
+                      for library in self.server.libraries.values()]
+            self._send_json(groups, 0)
+            return
+        if len(parts) < 3 or parts[0] != 'groups' or parts[1] not in self.server.libraries:
+            self._send(404, "Not found", 'text/plain')
+            return
+        library = self.server.libraries[parts[1]]
+        with library._lock:
+            self._answer(library, parts[2:], params)
+
+    def _answer(self, library, parts, params):
+        """Answers a request for a library, parts is the path after '/groups/<group_id>'.
+        """
+        since = int(params.get('since') or 0)
+        if parts == ['deleted']:
+            deleted = dict((name, [key for key, version in objects.iteritems() if version > since])
+                           for name, objects in library.deleted.iteritems())
+            self._send_json(deleted, library.version)
+            return
+        if len(parts) == 3 and parts[0] == 'items' and parts[2] == 'file':
+            if parts[1] not in library.files:
+                self._send(404, "Not found", 'text/plain')
+                return
+            item = library.items[parts[1]]
+            self._send(200, library.files[parts[1]], item[u'contentType'], 
+                       {'Last-Modified-Version': str(library.version)})
+            return
+        # The results are kept for the pages that follow, until the library changes
+        results_key = (tuple(parts), params.get('collectionKey'), params.get('itemKey'), since)
+        if library._results_version != library.version:
+            library._results.clear()
+            library._results_version = library.version
+        if results_key not in library._results:
+            library._results[results_key] = self._find(library, parts, params, since)
+        found = library._results[results_key]
+        if found is None:
+            self._send(404, "Not found", 'text/plain')
+            return
+        # For multiple objects, zotero compares the version with the library version, so any 
+        # change in the library is a change in the result
+        modified_since = self.headers.get('If-Modified-Since-Version')
+        if modified_since is not None and library.version <= int(modified_since):
+            self._send(304, "", 'text/plain', {'Last-Modified-Version': str(library.version)})
+            return
+        if params.get('format') == 'versions':
+            self._send_json(dict((data[u'key'], data[u'version']) for data in found), 
+                            library.version)
+            return
+        self._send_page(library, found, params)
+
+    def _find(self, library, parts, params, since):
+        """Finds the objects for a request. Returns the list of objects sorted by key, or None if
+        the path is not known.
+        """
+        if parts == ['collections']:
+            results = library.collections.values()
+            if params.get('collectionKey'):
+                results = [library.collections[key] for key in params['collectionKey'].split(',')
+                           if key in library.collections]
+        else:
+            if parts == ['items']:
+                results = library.items.values()
+                if params.get('itemKey'):
+                    results = [library.items[key] for key in params['itemKey'].split(',')
+                               if key in library.items]
+            elif len(parts) == 3 and parts[0] == 'collections' and parts[2] == 'items':
+                results = [item for item in library.items.values() 
+                           if parts[1] in item.get(u'collections', [])]
+                keys = set(item[u'key'] for item in results)
+                results += [item for item in library.items.values() 
+                            if item.get(u'parentItem') in keys]
+            elif len(parts) == 3 and parts[0] == 'items' and parts[2] == 'children':
+                results = [item for item in library.items.values() 
+                           if item.get(u'parentItem') == parts[1]]
+            else:
+                return None
+        results = [data for data in results if data[u'version'] > since]
+        results.sort(key=lambda data: data[u'key'])
+        return results
+
+    def _send_page(self, library, results, params):
+        """Sends one page of results, with the 'Total-Results' header and a 'Link' header for the 
+        next page.
+        """
+        version = library.version
+        start = int(params.get('start') or 0)
+        limit = params.get('limit')
+        limit = min(int(limit), MAX_LIMIT) if limit and limit.isdigit() else DEFAULT_LIMIT
+        page = results[start:start + limit]
+        headers = {'Total-Results': str(len(results))}
+        if start + limit < len(results):
+            next_params = dict(params, start=str(start + limit), limit=str(limit))
+            next_url = (self.server.get_url() + urlparse.urlparse(self.path).path + "?" + 
+                        "&".join(name + "=" + value for name, value in sorted(next_params.items())))
+            headers['Link'] = '<' + next_url + '>; rel="next"'
+        if params.get('format') == 'keys':
+            body = "\n".join(data[u'key'] for data in page).encode('utf-8')
+            self._send(200, body, 'text/plain', dict(headers, **{'Last-Modified-Version': 
+                                                                 str(version)}))
+            return
+        self._send_json([self._get_envelope(library, data) for data in page], version, headers)
+
+    def _get_envelope(self, library, data):
+        """Returns the envelope of an object, as in the zotero api: the 'key', 'version', 
+        'library', 'links' and 'meta' of the object, and the object itself as 'data'. For items 
+        that can have children, the meta has the 'numChildren'.
+        """
+        kind = u'items' if u'itemType' in data else u'collections'
+        url = (self.server.get_url() + "/groups/" + str(library.group_id) + "/" + kind + "/" + 
+               data[u'key'])
+        meta = {}
+        if kind == u'items' and data[u'itemType'] not in (u'attachment', u'note'):
+            meta[u'numChildren'] = library.get_num_children(data[u'key'])
+        return {u'key': data[u'key'], u'version': data[u'version'], 
+                u'library': {u'type': u'group', u'id': library.group_id, u'name': library.name},
+                u'links': {u'self': {u'href': url, u'type': u'application/json'}}, 
+                u'meta': meta, u'data': data}
+
+    def _send_json(self, data, version, headers=None):
+        """Sends a json reply.
+        """
+        headers = dict(headers or {})
+        headers['Last-Modified-Version'] = str(version)
+        self._send(200, json.dumps(data), 'application/json', headers)
+
+    def _send(self, status, body, content_type, headers=None):
+        """Sends a reply.
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Requests are not logged.
+        """
+        pass
+
+# ================================================================================================
+# Main
+# ================================================================================================
+
+def create_demo_library(group_id=1, name=u'Webtero Demo'):
+    """Creates a small library with one website: a 'Websites/Demo' collection with two tabs and a 
+    head, a '_Files' collection with a template, and an empty '_Images' collection.
+    """
+    library = MockLibrary(group_id, name)
+    websites = library.add_collection(u'Websites')
+    demo = library.add_collection(u'Demo', websites)
+    files = library.add_collection(u'_Files', websites)
+    library.add_collection(u'_Images', websites)
+    template = library.add_item(u'Template', [files])
+    library.add_attachment(template, u'template.html', 
+                           "<html><head><title>{{ head.title }}</title></head><body>" 
+                           "<ul>{{ buttons }}</ul>{{ content }}</body></html>", u'text/html')
+    for number in range(1, 3):
+        tab = library.add_item(u'Tab ' + str(number), [demo], callNumber=unicode(number))
+        library.add_attachment(tab, u'tab' + str(number) + '.html', 
+                               "<html><body><h1>Tab " + str(number) + "</h1></body></html>", 
+                               u'text/html')
+    library.add_item(u'Head', [demo], item_type=u'webpage')
+    return library
+
+if __name__ == "__main__":
+    port = 8080
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    server = MockZoteroServer([create_demo_library()], port)
+    print "Serving a mock zotero api at " + server.get_url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopped."
@@ -23,10 +23,27 @@
 """
 
 from pyzotero import zotero
-import urllib
 import os
 import traceback
-import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+from zotero_cache import ZoteroCache
+from zotero_files import get_api_url, get_downloader, get_store
+from zotero_scheduler import get_scheduler
+from build_metrics import get_metrics
+
+# The max number of keys in one itemKey or collectionKey request
+BATCH_SIZE = 50
+# The number of results in each page, the max allowed by the api is 100
+PAGE_SIZE = 100
+# The string fields that most items have, each is kept in a slot. Other fields are kept in a dict.
+ITEM_FIELDS = ('itemType', 'title', 'date', 'callNumber', 'url', 'abstractNote', 'extra', 
+               'dateAdded', 'dateModified', 'accessDate')
+# The string fields that most attachments have, in addition to the ITEM_FIELDS
+ATTACHMENT_FIELDS = ('linkMode', 'contentType', 'charset', 'filename', 'md5', 'note')
+# The string fields that only have a few different values, these values are interned
+INTERNED_FIELDS = frozenset(['itemType', 'linkMode', 'contentType', 'charset'])
 
 # ================================================================================================
 # Main Reader
@@ -36,16 +53,30 @@ class ZoteroGroup(object):
     """ Reads a group in zotero database.
     """
 
-    def __init__(self, group_name, zot_id, zot_key):
-        """Make the connection to a group.
+    def __init__(self, group_name, zot_id, zot_key, cache=None, incremental=False):
+        """Make the connection to a group. If a ZoteroCache is given, the responses from zotero are
+        cached, keyed by the library version of the group. If incremental is True, the cached 
+        responses from the last version that was seen are updated with only the changes since that 
+        version, instead of being downloaded again.
         """
         # Login
         self.name = group_name
         self.zot_id = zot_id
         self.zot_key = zot_key
+        self.cache = cache
+        self.incremental = incremental
         self.uid = None
+        self.version = None
         self.group_conn = None
+        # True when the collections have been read
+        self.initialized = False
+        # The traceback if the last sync failed, else None
+        self.sync_error = None
+        self._local = threading.local()
         self.collections = {}
+        self.collections_by_uid = {}
+        self.tree = ZoteroCollectionTree([])
+        self._colls_data = []
 
     def initialize_connection(self):
         """Tries to create a connection with the zotero database.
@@ -56,14 +87,18 @@ class ZoteroGroup(object):
         if not user_connection:
             info_str += "ERROR: Cannot connect to zotero user level database.\n"
             return info_str
-        groups = user_connection.groups()
+        user_connection.endpoint = get_api_url()
+        groups = get_scheduler().call(user_connection.groups, 
+                                      get_response=lambda: getattr(user_connection, 'request', None),
+                                      endpoint='groups')
+        groups = _get_flat_data(groups)
         # Find the right group
         group_id = None
         for group in groups:
             if group[u'name'] == self.name:
                 group_id = group[u'group_id']
         if not group_id:
-            info_str += "Can not find group '", self.name, "'\n"
+            info_str += "ERROR: Can not find group '" + self.name + "'\n"
             return info_str
         # Create a connection to that group
         info_str += self._initialize_conn_by_uid(group_id)
@@ -79,11 +114,224 @@ class ZoteroGroup(object):
         self.group_conn = zotero.Zotero(group_uid, 'group', self.zot_key)
         if not self.group_conn:
             info_str += "ERROR: Cannot connect to zotero group level database.\n"
+        else:
+            self.group_conn.endpoint = get_api_url()
+        self._local = threading.local()
+        self._local.conn = self.group_conn
+        # Get the library version, used as the key for the cache
+        info_str += self._initialize_version()
         # Get the collections
         info_str += self._initialize_collections()
         # Return the info
         return info_str
 
+    def _initialize_version(self):
+        """Gets the current library version of the group. This is a small request, and is used to 
+        decide if the cached responses are still valid. In incremental mode, the cached responses 
+        for the last version that was seen are patched up to the current version.
+        """
+        info_str = "Getting the library version of this group from zotero.\n"
+        self.version = None
+        try:
+            version = int(self.call('last_modified_version'))
+        except Exception:
+            info_str += "ERROR: could not get the library version, the cache will not be used.\n"
+            info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
+            return info_str
+        if self.cache is not None:
+            last_version = self.cache.get_sync_version(self.uid)
+            if self.incremental and last_version is not None and last_version < version:
+                info_str += "Syncing changes since version " + str(last_version) + ".\n"
+                try:
+                    changes = self._get_changes(last_version)
+                    self.cache.carry_forward(self.uid, last_version, version, changes.patch)
+                except Exception:
+                    info_str += "ERROR: could not sync changes, all data will be downloaded.\n"
+                    info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
+            self.cache.set_sync_version(self.uid, version)
+        self.version = version
+        return info_str
+
+    def _get_changes(self, since):
+        """Gets the collections and items that were changed or deleted since a library version. 
+        Only the keys are downloaded for the whole library, and then the data for the changed 
+        collections and items is downloaded in batches.
+        """
+        coll_keys = self.call('collection_versions', since=since).keys()
+        item_keys = self.call('item_versions', since=since).keys()
+        deleted = self.call('deleted', since=since)
+        changes = ZoteroChanges(deleted.get(u'collections', []), deleted.get(u'items', []))
+        for i in range(0, len(coll_keys), BATCH_SIZE):
+            batch = coll_keys[i:i + BATCH_SIZE]
+            for coll_data in self.call('collections', collectionKey=','.join(batch), 
+                                       limit=BATCH_SIZE):
+                changes.colls[coll_data[u'collectionKey']] = coll_data
+        for i in range(0, len(item_keys), BATCH_SIZE):
+            batch = item_keys[i:i + BATCH_SIZE]
+            for item_data in self.call('items', itemKey=','.join(batch), limit=BATCH_SIZE):
+                changes.items[item_data[u'key']] = item_data
+        return changes
+
+    def sync(self):
+        """Updates the data in this group with the changes made in zotero since the last time the 
+        data was read. The collections and the items that have already been downloaded are 
+        updated in place. Returns an info str. If the sync fails, the traceback is kept in 
+        sync_error.
+        """
+        info_str = "Syncing the group '" + self.name + "' with zotero.\n"
+        self.sync_error = None
+        try:
+            version = int(self.call('last_modified_version'))
+            if self.version is not None and version == self.version:
+                info_str += "The group is up to date, version " + str(version) + ".\n"
+                return info_str
+            if self.version is None:
+                # Nothing is known about the old data, so get everything again
+                for coll in self.collections.values():
+                    coll.attachments = None
+                    coll.items = None
+                self.version = version
+                info_str += self._initialize_collections()
+                return info_str
+            changes = self._get_changes(self.version)
+            if self.cache is not None:
+                self.cache.carry_forward(self.uid, self.version, version, changes.patch)
+                self.cache.set_sync_version(self.uid, version)
+            self._colls_data = changes.patch('collections', self._colls_data)
+            self._update_collections()
+            for coll in self.collections.values():
+                coll.apply_changes(changes)
+            info_str += "Synced to version " + str(version) + ": " + str(changes) + "\n"
+            self.version = version
+        except Exception:
+            self.sync_error = traceback.format_exc()
+            info_str += "ERROR: something went wrong trying to sync the group."
+            info_str += "EXCEPTION: \n" + self.sync_error + "\n"
+        return info_str
+
+    def call(self, method_name, *args, **kwargs):
+        """Calls a method on the pyzotero connection through the request scheduler, so that the 
+        api rate limits are respected and failed requests are retried. Lists of objects are 
+        returned as flat data, see _get_flat_data().
+        """
+        conn = self._get_conn()
+        result = get_scheduler().call(getattr(conn, method_name), args, kwargs, 
+                                      lambda: getattr(conn, 'request', None), method_name)
+        return _get_flat_data(result)
+
+    def _get_conn(self):
+        """Returns the pyzotero connection to this group for the current thread. Pyzotero keeps the
+        last response (and the request parameters) in the connection, so a connection cannot be
+        shared by the threads that download pages in the background.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = zotero.Zotero(self.uid, 'group', self.zot_key)
+            conn.endpoint = self.group_conn.endpoint
+            self._local.conn = conn
+        return conn
+
+    def request(self, method_name, *args):
+        """Calls a method on the pyzotero connection, e.g. request('children', item_uid), and 
+        returns the list of results from all the pages. If the response is in the cache for the 
+        current library version, zotero is not called.
+        """
+        data = []
+        for page in self.iter_pages(method_name, *args):
+            data.extend(page)
+        return data
+
+    def iter_pages(self, method_name, *args, **kwargs):
+        """A generator that calls a method on the pyzotero connection one page at a time, and 
+        yields the list of results for each page. While a page is being used, the next page is 
+        downloaded in the background. If the response is in the cache for the current library 
+        version, or zotero says that the cached response for an older version has not changed, the 
+        whole response is yielded as one page.
+
+        With use_cache=False the cache is not used: the pages are always downloaded, and only one 
+        page at a time is kept, so that large responses can be streamed.
+        """
+        use_cache = (kwargs.get('use_cache', True) and self.cache is not None and 
+                     self.version is not None)
+        request_key = "/".join([method_name] + [str(arg) for arg in args])
+        if use_cache:
+            cached_version, data = self.cache.get_entry(self.uid, self.version, request_key)
+            result = 'hit'
+            if cached_version != self.version:
+                result = 'renewed'
+                if not self._revalidate(request_key, cached_version, data, method_name, *args):
+                    data = None
+            if data is not None:
+                get_metrics().inc('webtero_api_cache_total', result=result)
+                yield data
+                return
+            get_metrics().inc('webtero_api_cache_total', result='miss')
+        args = (method_name,) + args
+        # Most responses are one page, so the pool is only created when there is a second page
+        pool = None
+        try:
+            data = []
+            start = 0
+            page = self.call(*args, start=start, limit=PAGE_SIZE)
+            while page is not None:
+                start += PAGE_SIZE
+                next_page = None
+                if len(page) == PAGE_SIZE:
+                    if pool is None:
+                        pool = ThreadPool(1)
+                    next_page = pool.apply_async(self.call, args, {'start': start, 'limit': PAGE_SIZE})
+                if use_cache:
+                    data.extend(page)
+                yield page
+                page = None
+                if next_page is not None:
+                    page = next_page.get()
+            if use_cache:
+                self.cache.put(self.uid, self.version, request_key, data)
+        finally:
+            if pool is not None:
+                # The pool is closed but not joined (which is slow), the thread exits by itself
+                pool.close()
+
+    def _revalidate(self, request_key, cached_version, data, method_name, *args):
+        """If the cached response (data) is for an older library version (cached_version), gets the
+        keys and versions of the objects in the current response from zotero, which is much smaller
+        than the data. If they are the same as in the cached response, nothing has been added, 
+        changed or removed, so the cached response is moved to the current library version, and 
+        returns True.
+
+        Conditional requests cannot be used: for requests of multiple objects, zotero compares the 
+        'If-Modified-Since-Version' with the library version, so any change in the library is a 
+        change in every response.
+        """
+        if data is None or cached_version >= self.version:
+            return False
+        url = self._get_request_url(method_name, *args)
+        if url is None:
+            return False
+        try:
+            versions = get_downloader().get_versions(url, self.zot_key)
+        except Exception:
+            # The response will be downloaded again
+            return False
+        if versions != _get_versions(data):
+            return False
+        self.cache.renew(self.uid, request_key, cached_version, self.version)
+        return True
+
+    def _get_request_url(self, method_name, *args):
+        """Returns the api url for a pyzotero method, or None if the cached responses of the method
+        cannot be renewed.
+        """
+        downloader = get_downloader()
+        if method_name == 'collections':
+            return downloader.get_group_url(self.uid, "/collections")
+        if method_name == 'collection_items':
+            return downloader.get_group_url(self.uid, "/collections/" + args[0] + "/items")
+        if method_name == 'children':
+            return downloader.get_group_url(self.uid, "/items/" + args[0] + "/children")
+        return None
+
     def _initialize_collections(self):
         """The path specifies the collection where to get the items from. The root is the group 
         root. The path looks like '/coll1/coll2/coll3'. If the collection does not exist, returns
@@ -91,33 +339,39 @@ class ZoteroGroup(object):
         """
         info_str = "Initializing all the collections in this group from zotero.\n"
         try:
-            colls = self.group_conn.collections()
-            for coll in colls:
-                coll_id = coll[u'collectionKey']
-                coll_path = self._get_coll_path(colls, coll_id)
-                self.collections[coll_path] = ZoteroCollection(self, coll_path, coll_id)
+            self._colls_data = self.request('collections')
+            self._update_collections()
+            self.initialized = True
         except Exception:
             info_str += "ERROR: something went wrong trying to initializing collections."
             info_str += "EXCEPTION: \n" + traceback.format_exc() + "\n"
         # Return the info
         return info_str
 
-    def _get_coll_path(self, colls_data, coll_id):
-        """Recursive method that gets the parent and adds it to the start of the path.
-        """
-        parent_id = True
-        for a_coll in colls_data:
-            a_coll_id = a_coll[u'collectionKey']
-            if coll_id == a_coll_id:
-                parent_id = a_coll[u'parent']
-                coll_name = a_coll[u'name'].encode('utf-8')
-                break
-        if parent_id is True:
-            raise Exception()
-        elif parent_id is False:
-            return '/' + coll_name
-        else:
-            return self._get_coll_path(colls_data, parent_id) + '/' + coll_name
+    def _update_collections(self):
+        """Updates the collections dict from the collections data. The ZoteroCollection objects that
+        already exist are kept (with a new path if they were moved), so their data is not lost.
+        """
+        self.tree = ZoteroCollectionTree(self._colls_data)
+        old_collections = self.collections_by_uid
+        collections = {}
+        collections_by_uid = {}
+        for coll_id, coll_path in self.tree.paths.iteritems():
+            if coll_id in old_collections:
+                coll = old_collections[coll_id]
+                coll.path = coll_path
+            else:
+                coll = ZoteroCollection(self, coll_path, coll_id)
+            collections[coll_path] = coll
+            collections_by_uid[coll_id] = coll
+        self.collections.clear()
+        self.collections.update(collections)
+        self.collections_by_uid = collections_by_uid
+
+    def _get_coll_path(self, coll_id):
+        """Gets the path of a collection from the collection tree.
+        """
+        return self.tree.get_path(coll_id)
 
     def get_collection(self, path):
         """Returns a collection in this group. If the collection does not exist, returns None.
@@ -137,19 +391,98 @@ class ZoteroCollection(object):
         self.uid = uid
         self.attachments = None
         self.items = None
+        self.children = None
 
     def initialize_data(self):
         """Get the data from zotero. Note that the root '/' contains everything, but at the moment 
         this method actually return nothing. 
+
+        The items in a collection include the child attachments of the items, so the children of 
+        each item are set from this data, without a separate request for each item.
         """
-        coll_items_data = self.group.group_conn.collection_items(self.uid)
         self.attachments = []
         self.items = []
-        for coll_item_data in coll_items_data:
-            if coll_item_data[u'itemType'] == 'attachment':
-                self.attachments.append(ZoteroAttachment(self.group, coll_item_data))
-            else:
-                self.items.append(ZoteroItem(self.group, coll_item_data))
+        for page in self.group.iter_pages('collection_items', self.uid):
+            for coll_item_data in page:
+                self._add_item(coll_item_data)
+        self._index_children()
+
+    def iter_items(self, tag=None):
+        """A generator that yields the ZoteroItem objects in this collection. If the data has not 
+        been downloaded, the items are downloaded page by page and each object is only created 
+        when it is needed, and none of them are kept. The attachments of these items are 
+        downloaded when they are first requested.
+        """
+        if self.items is not None:
+            for item in self.get_items(tag):
+                yield item
+            return
+        for page in self.group.iter_pages('collection_items', self.uid, use_cache=False):
+            for coll_item_data in page:
+                if coll_item_data[u'itemType'] != 'attachment':
+                    item = ZoteroItem(self.group, coll_item_data)
+                    if not tag or item.has_tag(tag):
+                        yield item
+
+    def iter_attachments(self, tag=None):
+        """A generator that yields the ZoteroAttachment objects in this collection. If the data has 
+        not been downloaded, the items are downloaded page by page and each object is only created 
+        when it is needed, and none of them are kept.
+        """
+        if self.attachments is not None:
+            for att in self.get_attachments(tag):
+                yield att
+            return
+        for page in self.group.iter_pages('collection_items', self.uid, use_cache=False):
+            for coll_item_data in page:
+                if coll_item_data[u'itemType'] == 'attachment':
+                    att = ZoteroAttachment(self.group, coll_item_data)
+                    if not tag or att.has_tag(tag):
+                        yield att
+
+    def _index_children(self, indexed_uids=()):
+        """Creates the dict of child attachments, keyed by the uid of the parent item, and sets the 
+        attachments of the items in this collection. If no children were found for an item that 
+        has children (or may have, when numChildren is not known), the attachments of the item are
+        not set, so that they are requested when they are needed. The indexed_uids are the items 
+        that had children in the index before a sync, if they have none now, they were deleted.
+        """
+        self.children = {}
+        for att in self.attachments:
+            if att.parent_uid:
+                self.children.setdefault(att.parent_uid, []).append(att)
+        for item in self.items:
+            children = self.children.get(item.uid)
+            if children is not None:
+                item.attachments = children
+            elif item.uid in indexed_uids or item.num_children == 0:
+                item.attachments = []
+
+    def _add_item(self, item_data):
+        """Creates a ZoteroItem or ZoteroAttachment from the data, and adds it to this collection.
+        """
+        if item_data[u'itemType'] == 'attachment':
+            self.attachments.append(ZoteroAttachment(self.group, item_data))
+        else:
+            self.items.append(ZoteroItem(self.group, item_data))
+
+    def apply_changes(self, changes):
+        """Updates the items in this collection with a ZoteroChanges object. Nothing is done if the 
+        data has not been downloaded yet.
+        """
+        if self.items is None:
+            return
+        removed = changes.get_removed_keys()
+        self.items[:] = [item for item in self.items if item.uid not in removed]
+        self.attachments[:] = [att for att in self.attachments if att.uid not in removed]
+        # The items with children that were requested separately, not found in this collection
+        for item in self.items:
+            if item.uid not in self.children:
+                item.apply_changes(changes)
+        parent_uids = [item.uid for item in self.items]
+        for item_data in changes.get_collection_items(self.uid, parent_uids):
+            self._add_item(item_data)
+        self._index_children(set(self.children))
 
     def get_attachments(self, tag=None):
         """Returns a list of ZoteroAttachment objects. If the data does not exist, it gets it from 
@@ -192,42 +525,70 @@ class ZoteroCollection(object):
         return self.items
 
     def get_subcollections(self):
-        """Returns a list of paths to subcollections."
+        """Returns a list of the subcollections (only one level down), sorted by path.
         """
-        if path == '/':
-            path_list = ['',]
-        else:
-            path_list = path.split('/')
-        subcollections = []
-        for coll_path in self.group.collections.keys():
-            coll_path_list = coll_path.split('/')
-            if len(coll_path_list) == len(path_list) + 1:
-                if coll_path_list[:len(path_list)] == path_list:
-                    subcollections.append(self.group.collections[coll_path])
+        subcollections = [self.group.collections_by_uid[coll_id] 
+                          for coll_id in self.group.tree.get_children(self.uid)]
         subcollections.sort(key=lambda coll: coll.path)
         return subcollections
 
+    def get_descendants(self):
+        """Returns a list of all the nested subcollections at all levels, sorted by path.
+        """
+        descendants = [self.group.collections_by_uid[coll_id] 
+                       for coll_id in self.group.tree.get_descendants(self.uid)]
+        descendants.sort(key=lambda coll: coll.path)
+        return descendants
+
 
 class ZoteroItem(object):
     """A zotero Item. It has a unique id called 'uid'. Retrival of data from zotero is lazy - the 
     data is only downloaded the first time it is requiested.
+
+    The string fields of the data are attributes, encoded as utf-8. Groups can have many items, so
+    the items are kept small: the common fields (ITEM_FIELDS) are kept in slots, and the other 
+    fields in a dict that is only created if there are any, see __getattr__(). The names of the 
+    other fields that are empty (most of them, usually) are kept in a frozenset instead. The tags 
+    and the names of the empty fields are frozensets of interned strs, shared by all the items 
+    with the same tags or the same empty fields. Other attributes cannot be set.
     """
+    __slots__ = ('group', 'attachments', 'parent_uid', 'version', 'num_children', 'tags', 'uid', 
+                 '_extra', '_empty') + ITEM_FIELDS
+    # The names of the fields that are kept in slots
+    _SLOT_FIELDS = frozenset(ITEM_FIELDS)
+    # The creators are not read from the data
+    creators = "Dummy"
+
     def __init__(self, group, data):
         self.group = group
         self.attachments = None
-        self.tags = []
+        self.parent_uid = None
+        self.version = None
+        self.num_children = None
+        self.tags = _NO_SET
+        self._extra = None
+        empty = []
 
         # Extract items out of the data
         for key, value in data.iteritems():
             if key == u'tags':
-                for i in value:
-                    self.tags.append(i[u'tag'].encode('utf-8'))
+                self.tags = _get_tags(value)
             elif key == u'key':
                 self.uid = value.encode('utf-8')
+            elif key == u'parentItem':
+                if value:
+                    self.parent_uid = value.encode('utf-8')
+            elif key == u'version':
+                self.version = value
+            elif key == u'numChildren':
+                self.num_children = value
             elif isinstance(value, basestring):
-                setattr(self, key.encode('utf-8'), value.encode('utf-8'))
-
-        self.creators = "Dummy"
+                name = _get_field_name(key)
+                if value or name in self._SLOT_FIELDS:
+                    self._set_field(name, value.encode('utf-8'))
+                else:
+                    empty.append(name)
+        self._empty = _get_shared_set(empty)
 
         """
             else:
@@ -254,14 +615,62 @@ class ZoteroItem(object):
             #    if value:
             #        setattr(self, key.encode('utf-8'), value)
 
+    def _set_field(self, name, value):
+        """Sets a string field, in a slot or in the dict of other fields.
+        """
+        if name in INTERNED_FIELDS:
+            value = intern(value)
+        if name in self._SLOT_FIELDS:
+            setattr(self, name, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+
+    def __getattr__(self, name):
+        """Returns a field that is not kept in a slot. This is only called if there is no slot with
+        this name, or the slot is empty.
+        """
+        if name not in ('_extra', '_empty'):
+            extra = self._extra
+            if extra is not None and name in extra:
+                return extra[name]
+            if name in self._empty:
+                return ""
+        raise AttributeError("'" + type(self).__name__ + "' object has no attribute '" + 
+                             name + "'")
+
+    def get_fields(self):
+        """Returns a dict with all the string fields of this item.
+        """
+        fields = dict.fromkeys(self._empty, "")
+        fields.update(self._extra or {})
+        for name in self._SLOT_FIELDS:
+            try:
+                fields[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return fields
+
     def initialize_data(self):
         """Get the data from zotero.
         """
         self.attachments = []
-        items_data = self.group.group_conn.children(self.uid)
+        items_data = self.group.request('children', self.uid)
         for item_data in items_data:
             item = ZoteroAttachment(self.group, item_data)
             self.attachments.append(item)
+
+    def apply_changes(self, changes):
+        """Updates the children of this item with a ZoteroChanges object. Nothing is done if the 
+        children have not been downloaded yet.
+        """
+        if self.attachments is None:
+            return
+        removed = changes.get_removed_keys()
+        self.attachments[:] = [att for att in self.attachments if att.uid not in removed]
+        for item_data in changes.get_children(self.uid):
+            self.attachments.append(ZoteroAttachment(self.group, item_data))
     
     def get_attribs(self):
         """Return a list of teh attributes in this object.
@@ -272,9 +681,7 @@ class ZoteroItem(object):
     def has_tag(self, tag):
         """Check is this item has a specified tag.
         """
-        if tag in self.tags:
-            return True
-        return False
+        return tag in self.tags
 
     def get_attachments(self, tag=None):
         """Return the children of this item.
@@ -332,16 +739,25 @@ class ZoteroItem(object):
     def __str__(self):
         """An str representation.
         """
-        return str(self.__dict__)
+        data = self.get_fields()
+        data.update({'uid': getattr(self, 'uid', None), 'version': self.version, 
+                     'parent_uid': self.parent_uid, 'tags': sorted(self.tags)})
+        return str(data)
 
 
 class ZoteroAttachment(ZoteroItem):
     """A zotero attachment. It is the same an an item, except you can download the file. Retrival 
     of data from zotero is lazy - the data is only downloaded the first time it is requested.
+    The common attachment fields (ATTACHMENT_FIELDS) are also kept in slots.
     """
+    __slots__ = ('filepath', 'download_size', '_is_html', '_is_image') + ATTACHMENT_FIELDS
+    _SLOT_FIELDS = frozenset(ITEM_FIELDS + ATTACHMENT_FIELDS)
+
     def __init__(self, group, data):
         super(ZoteroAttachment, self).__init__(group, data)
         self.filepath = None
+        # The number of bytes downloaded by get_file(), 0 if the file was in the attachment store
+        self.download_size = None
         self._is_html = self.contentType == 'text/html'
         self._is_image = self.contentType.startswith('image')
 
@@ -357,22 +773,42 @@ class ZoteroAttachment(ZoteroItem):
 
     def get_file(self):
         """Get the actual file attachment from zotero db. Returns a local path where the image was
-        written to. Returns the temp file location.
+        written to. The file is kept in the attachment store, so if the same version of the file 
+        was already downloaded (in this run or an earlier one), zotero is not called.
         """
         if self.filepath is None:
-            url = "https://api.zotero.org/groups/"
-            url += self.group.uid
-            url += "/items/"
-            url += self.uid
-            url += "/file?key="
-            url += self.group.zot_key
-            result = urllib.urlretrieve(url)
-            if result:
-                self.filepath = result[0]
-            else:
-                raise Exception()
+            store = get_store()
+            md5 = getattr(self, 'md5', None)
+            tag = self.get_file_tag()
+            self.filepath = store.get(self.uid, tag, md5)
+            self.download_size = 0
+            source = 'store'
+            if self.filepath is None:
+                downloader = get_downloader()
+                url = downloader.get_file_url(self.group.uid, self.uid)
+                temp_filepath = store.get_temp_filepath(tag)
+                try:
+                    size = downloader.download(url, self.group.zot_key, temp_filepath)
+                except Exception:
+                    os.remove(temp_filepath)
+                    raise
+                self.filepath = store.put(self.uid, tag, temp_filepath, md5)
+                self.download_size = size
+                source = 'download'
+            get_metrics().inc('webtero_attachments_fetched_total', source=source)
         return self.filepath
 
+    def get_file_tag(self):
+        """Returns a tag for the version of the file, used as part of the name in the attachment 
+        store. Returns None if there is no md5 and no version.
+        """
+        md5 = getattr(self, 'md5', None)
+        if md5:
+            return md5
+        if self.version is not None:
+            return 'v' + str(self.version)
+        return None
+
     def get_file_data(self, binary=False):
         path = self.get_file()
         if binary:
@@ -384,21 +820,287 @@ class ZoteroAttachment(ZoteroItem):
         return data
 
 
+_NO_SET = frozenset()
+# The frozensets of tags and of field names that are shared by the items
+_SHARED_SETS = {_NO_SET: _NO_SET}
+# The names of the fields, keyed by the unicode names in the data
+_FIELD_NAMES = {}
+
+def _get_shared_set(values):
+    """Returns the values (interned strs) as a frozenset. The same frozenset is returned for all 
+    the items with the same values.
+    """
+    values = frozenset(values)
+    return _SHARED_SETS.setdefault(values, values)
+
+def _get_tags(tags_data):
+    """Returns the tags in the data of an item as a frozenset of interned utf-8 strs, see 
+    _get_shared_set().
+    """
+    return _get_shared_set(intern(tag_data[u'tag'].encode('utf-8')) for tag_data in tags_data)
+
+def _get_flat_data(result):
+    """The zotero api (v3) sends each object in an envelope, with the object itself as 'data' and 
+    the 'numChildren' of items in 'meta'. The reader uses the flat data of the older api: items 
+    have 'numChildren', collections have 'collectionKey' and 'parent', and groups have 'group_id'. 
+    Returns a list of objects as flat data. Other results, and objects that are already flat (e.g.
+    from the cache), are returned unchanged.
+    """
+    if not isinstance(result, list):
+        return result
+    flat_result = []
+    for obj in result:
+        if isinstance(obj, dict) and isinstance(obj.get(u'data'), dict):
+            data = dict(obj[u'data'])
+            if u'itemType' in data:
+                if u'numChildren' in (obj.get(u'meta') or {}):
+                    data[u'numChildren'] = obj[u'meta'][u'numChildren']
+            elif u'id' in data:
+                data[u'group_id'] = data[u'id']
+            else:
+                data[u'collectionKey'] = data[u'key']
+                data[u'parent'] = data.get(u'parentCollection', False)
+            obj = data
+        flat_result.append(obj)
+    return flat_result
+
+def _get_versions(data):
+    """Returns the versions of the objects in a response, as a dict keyed by the object key.
+    """
+    return dict((obj.get(u'key') or obj[u'collectionKey'], obj[u'version']) for obj in data)
+
+def _get_field_name(key):
+    """Returns the name of a field in the data of an item, as an interned utf-8 str.
+    """
+    name = _FIELD_NAMES.get(key)
+    if name is None:
+        name = _FIELD_NAMES.setdefault(key, intern(key.encode('utf-8')))
+    return name
+
+
+class ZoteroCollectionTree(object):
+    """An index of the nested collections in a group, created in one pass over the collections 
+    data. The dicts are: nodes (key -> data), parents (key -> parent key, None for the top level),
+    children (key -> list of keys, None for the top level), paths (key -> path) and keys 
+    (path -> key).
+    """
+    def __init__(self, colls_data):
+        self.nodes = {}
+        self.parents = {}
+        self.children = {None: []}
+        for coll in colls_data:
+            coll_id = coll[u'collectionKey']
+            self.nodes[coll_id] = coll
+            self.parents[coll_id] = coll[u'parent'] or None
+            self.children.setdefault(coll_id, [])
+        for coll_id, parent_id in self.parents.iteritems():
+            if parent_id is not None and parent_id not in self.nodes:
+                raise Exception("The parent of collection '" + coll_id + "' does not exist.")
+            self.children.setdefault(parent_id, []).append(coll_id)
+        self.paths = {}
+        for coll_id in self.nodes:
+            self._create_path(coll_id)
+        self.keys = dict((path, coll_id) for coll_id, path in self.paths.iteritems())
+
+    def _create_path(self, coll_id):
+        """Creates the path for a collection, and for any of its ancestors that do not have a path 
+        yet. Each path is only created once.
+        """
+        # Walk up until a collection with a path (or the top level) is found
+        branch = []
+        while coll_id is not None and coll_id not in self.paths:
+            if len(branch) > len(self.nodes):
+                raise Exception("The collection '" + coll_id + "' is its own ancestor.")
+            branch.append(coll_id)
+            coll_id = self.parents[coll_id]
+        path = self.paths[coll_id] if coll_id is not None else ''
+        # Walk back down, creating the paths
+        for coll_id in reversed(branch):
+            path = path + '/' + self.nodes[coll_id][u'name'].encode('utf-8')
+            self.paths[coll_id] = path
+
+    def get_path(self, coll_id):
+        """Returns the path of a collection.
+        """
+        return self.paths[coll_id]
+
+    def get_key(self, path):
+        """Returns the key of the collection with this path, or None.
+        """
+        return self.keys.get(path)
+
+    def get_children(self, coll_id=None):
+        """Returns a list of the keys of the children of a collection. If coll_id is None, the keys
+        of the top level collections are returned.
+        """
+        return self.children.get(coll_id, [])
+
+    def get_descendants(self, coll_id=None):
+        """Returns a list of the keys of all the collections nested in a collection, at all levels.
+        """
+        descendants = []
+        stack = list(self.get_children(coll_id))
+        while stack:
+            child_id = stack.pop()
+            descendants.append(child_id)
+            stack.extend(self.children[child_id])
+        return descendants
+
+
+class ZoteroChanges(object):
+    """The collections and items that were changed or deleted in a group since a library version. 
+    The changed collections and items are dicts of data keyed by the collection or item key.
+    """
+    def __init__(self, deleted_colls, deleted_items):
+        self.colls = {}
+        self.items = {}
+        self.deleted_colls = set(deleted_colls)
+        self.deleted_items = set(deleted_items)
+
+    def get_removed_keys(self):
+        """Returns the set of item keys where the existing data must be removed.
+        """
+        return self.deleted_items.union(self.items.keys())
+
+    def get_collection_items(self, coll_uid, parent_uids=()):
+        """Returns a list of the data of the changed items that are in a collection. Child items 
+        are included if their parent is in the collection, or is in parent_uids.
+        """
+        items_data = [data for data in self.items.values() 
+                      if coll_uid in data.get(u'collections', [])]
+        parent_uids = set(parent_uids).union([data[u'key'] for data in items_data])
+        items_data.extend([data for data in self.items.values() 
+                           if data.get(u'parentItem') in parent_uids])
+        return items_data
+
+    def get_children(self, item_uid):
+        """Returns a list of the data of the changed items that are children of an item.
+        """
+        return [data for data in self.items.values() if data.get(u'parentItem') == item_uid]
+
+    def patch(self, request_key, data):
+        """Applies the changes to the response for a request key (see ZoteroGroup.request). Returns
+        the updated response, or None if this type of response cannot be patched.
+        """
+        method_name, _, arg = request_key.partition('/')
+        if method_name == 'collections':
+            removed = self.deleted_colls.union(self.colls.keys())
+            data = [coll for coll in data if coll[u'collectionKey'] not in removed]
+            return data + self.colls.values()
+        removed = self.get_removed_keys()
+        if method_name == 'collection_items':
+            data = [item for item in data if item[u'key'] not in removed]
+            parent_uids = [item[u'key'] for item in data]
+            return data + self.get_collection_items(arg, parent_uids)
+        if method_name == 'children':
+            data = [item for item in data if item[u'key'] not in removed]
+            return data + self.get_children(arg)
+        return None
+
+    def __str__(self):
+        """An str representation.
+        """
+        return (str(len(self.colls)) + " collections changed, " + 
+                str(len(self.deleted_colls)) + " collections deleted, " + 
+                str(len(self.items)) + " items changed, " +
+                str(len(self.deleted_items)) + " items deleted.")
+
+
+# ================================================================================================
+# Group registry, so that each group is only connected to once per process
+# ================================================================================================
+
+_GROUPS = {}
+_GROUPS_LOCK = threading.Lock()
+_CACHE = []
+_CREDENTIALS = []
+INCREMENTAL_SYNC = True
+
+def get_cache():
+    """Returns the ZoteroCache used by the groups in the registry. The default cache is created the 
+    first time it is needed. Returns None if caching was switched off with set_cache(None).
+    """
+    if not _CACHE:
+        _CACHE.append(ZoteroCache())
+    return _CACHE[0]
+
+def set_cache(cache):
+    """Sets the ZoteroCache used by groups that are created after this call. Set to None to switch 
+    off caching.
+    """
+    del _CACHE[:]
+    _CACHE.append(cache)
+
+def get_credentials():
+    """Returns the zotero user id and key, (zot_id, zot_key), used by get_collection(). By default,
+    these are ZOT_ID and ZOT_KEY in the zotero_auth module.
+    """
+    if not _CREDENTIALS:
+        from zotero_auth import ZOT_ID, ZOT_KEY
+        _CREDENTIALS.append((ZOT_ID, ZOT_KEY))
+    return _CREDENTIALS[0]
+
+def set_credentials(zot_id, zot_key):
+    """Sets the zotero user id and key used by get_collection(), instead of the zotero_auth module.
+    """
+    del _CREDENTIALS[:]
+    _CREDENTIALS.append((zot_id, zot_key))
+
+def get_group(group_name, zot_id, zot_key):
+    """Returns the ZoteroGroup for this group name and credentials. The first time a group is 
+    requested, the connection is made and the collections are read. After that, the same 
+    ZoteroGroup object (and so the same ZoteroCollection objects) is returned. If the collections 
+    could not be read, an exception is raised and the group is not kept, so the next call tries 
+    again.
+    """
+    registry_key = (group_name, zot_id, zot_key)
+    with _GROUPS_LOCK:
+        if registry_key not in _GROUPS:
+            group = ZoteroGroup(group_name, zot_id, zot_key, get_cache(), INCREMENTAL_SYNC)
+            info_str = group.initialize_connection()
+            if group.group_conn is None:
+                raise Exception("Could not connect to the zotero group '" + group_name + "'.")
+            if not group.initialized:
+                raise Exception("Could not read the collections of the zotero group '" + 
+                                group_name + "'.\n" + info_str)
+            _GROUPS[registry_key] = group
+        return _GROUPS[registry_key]
+
+def invalidate_group(group_name=None, zot_id=None, zot_key=None):
+    """Removes groups from the registry, so that the next call to get_group() reconnects. If no 
+    group name is given, all groups are removed. If no credentials are given, the group is removed 
+    for all credentials.
+    """
+    with _GROUPS_LOCK:
+        for registry_key in _GROUPS.keys():
+            if group_name is not None and registry_key[0] != group_name:
+                continue
+            if zot_id is not None and registry_key[1] != zot_id:
+                continue
+            if zot_key is not None and registry_key[2] != zot_key:
+                continue
+            del _GROUPS[registry_key]
+
 # ================================================================================================
 # Utility Function to get items from a collection
 # ================================================================================================
 
-def get_collection(group_path):
-    """Get the items from the collection.
+def get_path_group(group_path):
+    """Get the group for a path that starts with the group name, e.g. 'group name/coll/sub coll'.
+    The group is taken from the group registry.
     """
     parts = group_path.split('/')
     if len(parts) < 2:
-        raise Exception()
-    group_name = parts[0]
-    coll_path = '/' + '/'.join(parts[1:])
-    from zotero_auth import ZOT_ID, ZOT_KEY
-    group = ZoteroGroup(group_name, ZOT_ID, ZOT_KEY)
-    group.initialize_connection()
+        raise Exception("The path '" + group_path + "' does not include a group name.")
+    zot_id, zot_key = get_credentials()
+    return get_group(parts[0], zot_id, zot_key)
+
+def get_collection(group_path):
+    """Get the items from the collection. The group is taken from the group registry, so calling
+    this multiple times for the same group only connects to zotero once.
+    """
+    group = get_path_group(group_path)
+    coll_path = '/' + '/'.join(group_path.split('/')[1:])
     return group.get_collection(coll_path)
 
 # ================================================================================================
@@ -0,0 +1,181 @@
+#!/usr/local/bin/python2.7
+# ================================================================================================
+#
+#    Copyright (c) 2008, Patrick Janssen (patrick@janssen.name)
+#
+#    This file is part of Webtero.
+#
+#    Webtero is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Webtero is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Webtero.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ================================================================================================
+"""Schedules the requests to the zotero api, so that the api rate limits are respected.
+"""
+
+import time
+import random
+import threading
+
+import requests
+
+from build_metrics import get_metrics
+
+# ================================================================================================
+# Scheduler
+# ================================================================================================
+
+# Status codes where the request is retried
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class RequestScheduler(object):
+    """All requests to the zotero api go through one scheduler. The scheduler does three things:
+    - it limits the rate of requests with a token bucket (rate requests per second on average, and
+      at most burst requests at once),
+    - it waits when the api asks clients to slow down, using the 'Backoff' and 'Retry-After'
+      headers,
+    - it retries requests that fail with a 429 or 5xx status (RETRY_STATUS_CODES) or a connection
+      error or timeout, waiting longer after each failure, with some random jitter. Other errors 
+      are raised at once. Only use it for idempotent (GET) requests.
+
+    The number of requests and their latency are recorded in the metrics, by endpoint.
+    """
+    def __init__(self, rate=5.0, burst=10, retries=5, backoff=1.0, max_wait=600.0):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.requests = 0
+        self.throttled = 0
+        self._tokens = float(burst)
+        self._last_time = time.time()
+        self._backoff_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request can be made.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                wait = self._backoff_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.requests += 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def set_backoff(self, seconds):
+        """No requests are made for this number of seconds.
+        """
+        seconds = min(float(seconds), self.max_wait)
+        with self._lock:
+            self._backoff_until = max(self._backoff_until, time.time() + seconds)
+
+    def call(self, func, args=(), kwargs=None, get_response=None, endpoint='other'):
+        """Calls func(*args, **kwargs) and returns the result. The get_response function should 
+        return the last http response (with headers and a status_code), for clients like pyzotero 
+        that do not return it. It is only used if the response changed during the call, and it 
+        must not be shared with other threads. Otherwise, the response is taken from the result, 
+        or from the exception. The endpoint is the name of the request in the metrics, e.g. 
+        'collections'.
+        """
+        if kwargs is None:
+            kwargs = {}
+        metrics = get_metrics()
+        for attempt in range(self.retries + 1):
+            self.acquire()
+            last_response = get_response() if get_response is not None else None
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                metrics.observe('webtero_api_request_duration_seconds', time.time() - start, 
+                                endpoint=endpoint)
+                response = getattr(exc, 'response', None)
+                if response is None and get_response is not None:
+                    response = get_response()
+                    if response is last_response:
+                        # No response was received in this call
+                        response = None
+                status = getattr(response, 'status_code', None)
+                metrics.inc('webtero_api_requests_total', endpoint=endpoint, 
+                            status=status or 'error')
+                retry = (status in RETRY_STATUS_CODES or 
+                         isinstance(exc, (requests.ConnectionError, requests.Timeout)))
+                if not retry or attempt == self.retries:
+                    raise
+                self._wait_to_retry(attempt, status, response)
+                continue
+            metrics.observe('webtero_api_request_duration_seconds', time.time() - start, 
+                            endpoint=endpoint)
+            response = result
+            if get_response is not None and get_response() is not last_response:
+                response = get_response()
+            status = getattr(response, 'status_code', None)
+            metrics.inc('webtero_api_requests_total', endpoint=endpoint, status=status or 'ok')
+            if status in RETRY_STATUS_CODES:
+                # Some clients (e.g. pyzotero for a 429) return the body of a failed response
+                if attempt == self.retries:
+                    raise Exception("The request to '" + endpoint + "' failed with status " + 
+                                    str(status) + ".")
+                self._wait_to_retry(attempt, status, response)
+                continue
+            self._observe(response)
+            return result
+
+    def _wait_to_retry(self, attempt, status, response):
+        """Waits before retrying a failed request, longer after each failed attempt.
+        """
+        if status == 429:
+            self.throttled += 1
+        self._observe(response)
+        time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def _observe(self, response):
+        """Reads the 'Backoff' and 'Retry-After' headers of a response.
+        """
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return
+        for name in ('Backoff', 'Retry-After'):
+            value = headers.get(name)
+            if value:
+                try:
+                    self.set_backoff(value)
+                except ValueError:
+                    pass
+
+# ================================================================================================
+# The scheduler used by the zotero reader
+# ================================================================================================
+
+_SCHEDULER = []
+
+def get_scheduler():
+    """Returns the RequestScheduler used for all requests to zotero. It is created the first time it
+    is needed.
+    """
+    if not _SCHEDULER:
+        _SCHEDULER.append(RequestScheduler())
+    return _SCHEDULER[0]
+
+def set_scheduler(scheduler):
+    """Sets the RequestScheduler used for all requests to zotero.
+    """
+    del _SCHEDULER[:]
+    _SCHEDULER.append(scheduler)